@@ -1,12 +1,58 @@
 """
-This module helps reduce the need to know arcpy for mapping. There are a few basic functions here that, when combined correctly, can create any number of maps quickly. This tool can use multiple CSVs, columns, and MXDs to create a large number of maps. Module users should use the create_dir() function first to set-up the correct C:/Mapping_Project structure. This module is designed to work with a csv containing values that should be mapped using graduated symbology. The user needs a CSV, shapefiles for mapping, mapping documents (.mxd files), and symbology.
+This module helps reduce the need to know arcpy for mapping. There are a few basic functions here that, when combined correctly, can create any number of maps quickly. This tool can use multiple CSVs, columns, and MXDs to create a large number of maps. Module users should use the create_dir() function first to set-up the correct C:/Mapping_Project structure. This module is designed to work with a csv containing values that should be mapped using graduated symbology. The user needs a CSV, shapefiles for mapping, mapping documents (.mxd files), and symbology. arcpy is imported the first time a shapefile, geodatabase or mapping function is used, so the CSV functions (file_getcols(), file_sort(), file_loadtable() and file_classbreaks()) can be used on a machine without ArcGIS.
 """
-import arcpy
+import array
+import atexit
 import operator
 import os
 import itertools
 from glob import glob
 import csv
+import hashlib
+import heapq
+import importlib
+import json
+import math
+import multiprocessing
+import Queue
+import shutil
+import sys
+import tempfile
+import threading
+import time
+try:
+    import numpy
+except ImportError:
+    numpy = None
+try:
+    import yaml
+except ImportError:
+    yaml = None
+try:
+    from PIL import Image, ImageDraw
+except ImportError:
+    Image = None
+
+
+class _LazyModule(object):
+    """Stands in for a module until one of its attributes is used. arcpy takes several seconds to import and checks out a license, so it is only imported by the first function that needs it. The CSV functions never import it. Once imported, the module replaces this object in the archelper namespace."""
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def _load(self):
+        if self._module is None:
+            with _stage('import_' + self._name):
+                self._module = importlib.import_module(self._name)
+            globals()[self._name] = self._module
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+
+arcpy = _LazyModule('arcpy')
 
 
 def create_dir(folderpath='C:/Mapping_Project'):
@@ -42,63 +88,633 @@ def create_workspace(name):
     return gdbpath
 
 
-def csv_checkmissingshpvals(inputfile, joincol, shapefile, shapefileheader, headers=True, filedelimiter=","):
-    """Checks to see if any join column values in the inputfile are missing in the  shapefile or geodatabase table. The shapefile/geodatabase table can also be a geodatabase table. Returns a list of missing inputfile values in a shapefile that wil not be mapped. Headers is True by default.
+_profile = {'enabled': False, 'logpath': None, 'records': []}
+
+
+def profile_start(logpath=None):
+    """Turns on timing for the join, sort, coverage check, add column and map functions. Each stage of those functions records its wall time, the rows it handled and the bytes it wrote. If logpath is given, every record is also appended to that file as one line of json. Profiling is off by default and costs nothing when it is off. It can also be turned on by setting the ARCHELPER_PROFILE environment variable to a log path before the module is imported. The summary table is then printed when Python exits unless profile_stop() was called first."""
+    _profile['enabled'] = True
+    _profile['logpath'] = logpath
+    _profile['records'] = []
+
+
+def profile_stop(summary=True):
+    """Turns off timing, prints the summary table if summary is True and returns the list of records."""
+    _profile['enabled'] = False
+    if summary:
+        profile_summary()
+    return _profile['records']
+
+
+def profile_summary():
+    """Prints a table with the number of calls, total seconds, rows and bytes written for each stage recorded since profile_start(). Stages in worker processes from map_create1(processes=N) are not included; the parallel run is recorded as one stage."""
+    totals = {}
+    order = []
+    for record in _profile['records']:
+        if record['stage'] not in totals:
+            totals[record['stage']] = [0, 0.0, 0, 0]
+            order.append(record['stage'])
+        total = totals[record['stage']]
+        total[0] += 1
+        total[1] += record['seconds']
+        total[2] += record['rows']
+        total[3] += record['bytes']
+    alltime = sum(total[1] for total in totals.itervalues()) or 1.0
+    print '%-34s %7s %10s %7s %12s %14s' % ('STAGE', 'CALLS', 'SECONDS', '%TIME', 'ROWS', 'BYTES')
+    for stage in order:
+        calls, seconds, rows, written = totals[stage]
+        print '%-34s %7d %10.3f %7.1f %12d %14d' % (stage, calls, seconds, seconds * 100 / alltime, rows, written)
+
+
+class _Stage(object):
+    """Times one stage for the profiler. Set rows and bytes inside the with block."""
+
+    def __init__(self, name, info):
+        self.name = name
+        self.info = info
+        self.rows = 0
+        self.bytes = 0
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *args):
+        record = {'stage': self.name, 'start': self.start, 'seconds': time.time() - self.start, 'rows': self.rows, 'bytes': self.bytes}
+        record.update(self.info)
+        _profile['records'].append(record)
+        if _profile['logpath']:
+            with open(_profile['logpath'], 'ab') as logfile:
+                logfile.write(json.dumps(record) + '\n')
+        return False
+
+
+class _NoStage(object):
+    """Stands in for _Stage when profiling is off."""
+    rows = 0
+    bytes = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def __setattr__(self, name, value):
+        pass
+
+
+_NOSTAGE = _NoStage()
+
+
+def _stage(name, **info):
+    """Returns a context manager that records the stage when profiling is on. info is added to the record."""
+    if not _profile['enabled']:
+        return _NOSTAGE
+    return _Stage(name, info)
+
+
+def _profile_atexit():
+    """Prints the summary table when Python exits if profiling is still on, so a run profiled with ARCHELPER_PROFILE does not need to call profile_stop(). Worker processes do not print it."""
+    if _profile['enabled'] and multiprocessing.current_process().name == 'MainProcess':
+        profile_stop()
+
+
+if os.environ.get('ARCHELPER_PROFILE'):
+    profile_start(os.environ['ARCHELPER_PROFILE'])
+    atexit.register(_profile_atexit)
+
+
+_keyindex_cache = {}
+_staged_tables = {}
+_staged_digests = {}
+
+
+def _table_mtime(table):
+    """Returns a modification time for a shapefile or geodatabase table that changes when the table is edited. Shapefiles use the .dbf file. Geodatabase tables use the newest file in the .gdb folder. Returns None if no file can be found."""
+    if table[-4:].lower() == ".shp":
+        dbf = table[:-4] + ".dbf"
+        if os.path.exists(dbf):
+            return os.path.getmtime(dbf)
+    gdbindex = table.lower().find('.gdb')
+    if gdbindex != -1:
+        gdbpath = table[:gdbindex + 4]
+        if os.path.isdir(gdbpath):
+            return max([os.path.getmtime(os.path.join(gdbpath, f)) for f in os.listdir(gdbpath)] or [os.path.getmtime(gdbpath)])
+    if os.path.exists(table):
+        return os.path.getmtime(table)
+    return None
+
+
+def _isshp(table):
+    """Returns True if the table is a shapefile or an in_memory copy of a shapefile made by shp_stage(). Shapefile field names are limited to 10 characters."""
+    return table[-4:].lower() == ".shp" or _staged_tables.get(table, "")[-4:].lower() == ".shp"
+
+
+def shp_keyindex(shapefile, shapefileheader, refresh=False):
+    """Returns a dictionary of every shapefileheader value in the shapefile or geodatabase table mapped to the number of times it occurs. The values are converted to strings so they can be compared with csv values. The index is cached for each shapefile and column, so checking several CSVs against the same shapefile only reads the shapefile once. The cache is rebuilt when the shapefile changes on disk or when refresh is True."""
+    cachekey = (shapefile, shapefileheader)
+    mtime = _table_mtime(shapefile)
+    cached = _keyindex_cache.get(cachekey)
+    if cached and not refresh and mtime is not None and cached[0] == mtime:
+        return cached[1]
+    keyindex = {}
+    rowcount = 0
+    with _stage('shp_keyindex', table=shapefile) as stage:
+        with arcpy.da.SearchCursor(shapefile, [shapefileheader]) as rows:
+            for row in rows:
+                key = str(row[0])
+                keyindex[key] = keyindex.get(key, 0) + 1
+                rowcount += 1
+        stage.rows = rowcount
+    _keyindex_cache[cachekey] = (mtime, keyindex)
+    return keyindex
+
+
+def csv_checkcoverage(inputfile, joincol, shapefile, shapefileheader, headers=True, filedelimiter=","):
+    """Compares the join column values in the inputfile with the shapefileheader values in the shapefile or geodatabase table. Uses the cached index from shp_keyindex(), so the shapefile is read once no matter how many CSVs are checked against it. Returns a dictionary with the following keys:
+    csv_missing: inputfile join values with no match in the shapefile, in file order. These values will not be mapped.
+    shp_missing: shapefile join values with no match in the inputfile. These features will have no data.
+    csv_duplicates: inputfile join values that occur more than once. Only the first row will be joined.
+    shp_duplicates: shapefile join values that occur more than once.
+    csv_rows, shp_rows: the number of rows read from each source.
+    The inputfile can be a path or a CsvTable.
 
         Default file delimiter is comma delimited but tab delimited can be used as well by specifiying '\t'.
     """
-    with open(inputfile, "rb") as csvdata:
-        csvinfo = csv.reader(csvdata, delimiter=filedelimiter)
+    keyindex = shp_keyindex(shapefile, shapefileheader)
+    csvkeys = {}
+    csvmissing = []
+    csvduplicates = []
+    csvrows = 0
+    if isinstance(inputfile, CsvTable):
+        keys = inputfile.text(joincol)
+    else:
+        keys = _file_rows(inputfile, filedelimiter)
         if headers:
-            csvinfo.next()
-        shpvals = []
-        rows = arcpy.da.SearchCursor(shapefile, fields=shapefileheader)
-        for row in rows:
-            shpvals.append(str(row.getValue(shapefileheader)))
-        results = []
-        for l in csvinfo:
-            if l[joincol] not in shpvals:
-                results.append(l[joincol])
-        if not results:
-            print "All inputfile join values have a join value in the shapefile/table."
-        return results
+            keys.next()
+        keys = (l[joincol] for l in keys)
+    with _stage('csv_checkcoverage.csv_scan') as stage:
+        for key in keys:
+            csvrows += 1
+            count = csvkeys.get(key, 0)
+            if count == 1:
+                csvduplicates.append(key)
+            csvkeys[key] = count + 1
+            if key not in keyindex:
+                csvmissing.append(key)
+        stage.rows = csvrows
+    shpmissing = [key for key in keyindex if key not in csvkeys]
+    shpduplicates = [key for key, count in keyindex.iteritems() if count > 1]
+    return {'csv_missing': csvmissing,
+            'shp_missing': sorted(shpmissing),
+            'csv_duplicates': csvduplicates,
+            'shp_duplicates': sorted(shpduplicates),
+            'csv_rows': csvrows,
+            'shp_rows': sum(keyindex.itervalues())}
+
+
+def csv_checkmissingshpvals(inputfile, joincol, shapefile, shapefileheader, headers=True, filedelimiter=","):
+    """Checks to see if any join column values in the inputfile are missing in the  shapefile or geodatabase table. The shapefile/geodatabase table can also be a geodatabase table. Returns a list of missing inputfile values in a shapefile that wil not be mapped. Headers is True by default. Use csv_checkcoverage() for a full report that includes shapefile values missing from the inputfile and duplicate join values.
+
+        Default file delimiter is comma delimited but tab delimited can be used as well by specifiying '\t'.
+    """
+    results = csv_checkcoverage(inputfile, joincol, shapefile, shapefileheader, headers, filedelimiter)['csv_missing']
+    if not results:
+        print "All inputfile join values have a join value in the shapefile/table."
+    return results
+
+
+class CsvTable(object):
+    """A CSV file parsed once into typed columns. Pass a CsvTable in place of the inputfile or csvfile path to file_getcols(), file_sort(), file_classbreaks(), file_jointable(), csv_checkcoverage(), csv_checkmissingshpvals() and shp_joincsv() so a pipeline that uses the same CSV in several steps only parses it once.
+
+        The key column (keycol) and any columns in textcols are kept as text. The key values are interned so joins and lookups share one copy of each key. Every other column whose first 1000 values are all numbers or blank is stored as a numpy float array, with blanks and later values that are not numbers stored as nan. Other columns are kept as text. file_sort() writes back and text joins use the text of the numeric columns as it was in the CSV, so "00123" and "0.50" are kept and not the parsed number. That text is not held in memory. It is read the first time it is needed, from the cache if there is one or else from the CSV, which must not have changed since the table was loaded. The float arrays are only used for number sorts, double joins and class breaks.
+
+        If cache is True, the parsed columns are saved in a folder next to the CSV named <inputfile>.cache and the numeric columns and their text are memory-mapped from it the next time the table is loaded. The cache is only used while the CSV size and modified time are unchanged.
+    """
+    _sample_rows = 1000
+
+    def __init__(self, inputfile, keycol=0, headers=True, filedelimiter=",", textcols=None, cache=False):
+        if numpy is None:
+            raise ImportError("numpy is needed to load a CsvTable.")
+        self.path = inputfile
+        self.keycol = keycol
+        self.hasheaders = headers
+        self.filedelimiter = filedelimiter
+        self._textcols = sorted(textcols or [])
+        self._keyindex = None
+        self._cached = False
+        self._stamp = [os.path.getsize(inputfile), os.path.getmtime(inputfile)]
+        self._cachedir = inputfile + '.cache'
+        if cache and self._loadcache():
+            return
+        self._parse(keepraw=cache)
+        if cache:
+            self._savecache()
+            self._cached = True
+            self.raw = [None if isnumber else self.raw[i] for i, isnumber in enumerate(self.numeric)]
+
+    def __len__(self):
+        return len(self.columns[self.keycol])
+
+    def _parse(self, keepraw=False):
+        """Reads the CSV and fills the headers, numeric flags and columns. The text of the numeric columns is only kept if keepraw is True."""
+        with open(self.path, 'rb') as csvdata:
+            csvinfo = csv.reader(csvdata, delimiter=self.filedelimiter)
+            sample = list(itertools.islice(csvinfo, self._sample_rows + 1))
+            if self.hasheaders and sample:
+                self.headers = sample.pop(0)
+            else:
+                self.headers = ['Field' + str(i + 1) for i in range(len(sample[0]) if sample else 0)]
+            colcount = len(self.headers)
+            self.numeric = []
+            for i in range(colcount):
+                isnumber = i != self.keycol and i not in self._textcols
+                for line in sample:
+                    if isnumber and i < len(line) and line[i] != '' and not _isnumber(line[i]):
+                        isnumber = False
+                        break
+                self.numeric.append(isnumber)
+            columns = []
+            raw = []
+            for i in range(colcount):
+                if self.numeric[i]:
+                    columns.append(array.array('d'))
+                    raw.append([] if keepraw else None)
+                else:
+                    columns.append([])
+                    raw.append(columns[i])
+            nan = float('nan')
+            for line in itertools.chain(sample, csvinfo):
+                for i in range(colcount):
+                    val = line[i] if i < len(line) else ''
+                    if self.numeric[i]:
+                        if keepraw:
+                            raw[i].append(val)
+                        try:
+                            columns[i].append(float(val))
+                        except ValueError:
+                            columns[i].append(nan)
+                    elif i == self.keycol:
+                        columns[i].append(intern(val))
+                    else:
+                        columns[i].append(val)
+        self.columns = [numpy.frombuffer(column, dtype=numpy.float64) if self.numeric[i] else column for i, column in enumerate(columns)]
+        self.raw = [raw[i] if self.numeric[i] else self.columns[i] for i in range(colcount)]
+
+    def _cachemeta(self):
+        return {'stamp': self._stamp, 'keycol': self.keycol, 'hasheaders': self.hasheaders, 'filedelimiter': self.filedelimiter, 'textcols': self._textcols, 'version': 2}
+
+    def _loadcache(self):
+        """Loads the columns from the cache folder. Returns False if there is no cache or it does not match the CSV."""
+        meta = _json_load(os.path.join(self._cachedir, 'meta.json'))
+        if not meta or meta['settings'] != json.loads(json.dumps(self._cachemeta())):
+            return False
+        self.headers = [str(col) for col in meta['headers']]
+        self.numeric = meta['numeric']
+        self.columns = []
+        self.raw = []
+        for i, isnumber in enumerate(self.numeric):
+            column = numpy.load(os.path.join(self._cachedir, 'col' + str(i) + '.npy'), mmap_mode='r' if isnumber else None)
+            if not isnumber:
+                column = column.tolist()
+                if i == self.keycol:
+                    column = [intern(val) for val in column]
+                self.raw.append(column)
+            else:
+                self.raw.append(None)
+            self.columns.append(column)
+        self._cached = True
+        return True
+
+    def _savecache(self):
+        """Writes the columns to the cache folder. The meta file is written last so a partly written cache is never used."""
+        if os.path.isdir(self._cachedir):
+            shutil.rmtree(self._cachedir)
+        os.mkdir(self._cachedir)
+        for i, column in enumerate(self.columns):
+            if self.numeric[i]:
+                numpy.save(os.path.join(self._cachedir, 'col' + str(i) + '.npy'), column)
+                numpy.save(os.path.join(self._cachedir, 'raw' + str(i) + '.npy'), numpy.array(self.raw[i] or [''], dtype=str)[:len(column)])
+            else:
+                numpy.save(os.path.join(self._cachedir, 'col' + str(i) + '.npy'), numpy.array(column or [''], dtype=str)[:len(column)])
+        _json_save(os.path.join(self._cachedir, 'meta.json'), {'settings': self._cachemeta(), 'headers': self.headers, 'numeric': self.numeric})
+
+    def _loadraw(self):
+        """Loads the CSV text of the numeric columns. The text is memory-mapped from the cache folder if there is one, otherwise the CSV is read again."""
+        missing = [i for i, column in enumerate(self.raw) if column is None]
+        if not missing:
+            return
+        if self._cached:
+            for i in missing:
+                self.raw[i] = numpy.load(os.path.join(self._cachedir, 'raw' + str(i) + '.npy'), mmap_mode='r')
+            return
+        if [os.path.getsize(self.path), os.path.getmtime(self.path)] != self._stamp:
+            raise ValueError("The text of " + self.path + " can not be read because the file has changed since the table was loaded.")
+        raw = dict((i, []) for i in missing)
+        with open(self.path, 'rb') as csvdata:
+            csvinfo = csv.reader(csvdata, delimiter=self.filedelimiter)
+            if self.hasheaders:
+                next(csvinfo, None)
+            for line in csvinfo:
+                for i in missing:
+                    raw[i].append(line[i] if i < len(line) else '')
+        for i in missing:
+            self.raw[i] = raw[i]
+
+    def colindex(self, col):
+        """Returns the index of a column given its index or header name."""
+        if isinstance(col, (int, long)):
+            return col
+        return self.headers.index(col)
+
+    def column(self, col):
+        """Returns a column by index or header name. Numeric columns are numpy float arrays. Text columns are lists of strings."""
+        return self.columns[self.colindex(col)]
+
+    def text(self, col):
+        """Returns a column by index or header name as a list of strings as they were in the CSV."""
+        i = self.colindex(col)
+        if self.raw[i] is None:
+            self._loadraw()
+        return self.raw[i]
+
+    def keyindex(self):
+        """Returns a dictionary of key column value to the index of the first row with that value."""
+        if self._keyindex is None:
+            keyindex = {}
+            for i, key in enumerate(self.columns[self.keycol]):
+                keyindex.setdefault(key, i)
+            self._keyindex = keyindex
+        return self._keyindex
+
+    def rowvalues(self, row, start=0, end=None, astext=False):
+        """Returns the values of one row from column start up to column end. Numbers are floats with None for no data, or the strings from the CSV if astext is True."""
+        if astext:
+            end = len(self.columns) if end is None else end
+            if [i for i in xrange(start, end) if self.raw[i] is None]:
+                self._loadraw()
+            return [self.raw[i][row] for i in xrange(start, end)]
+        values = []
+        for i in xrange(start, len(self.columns) if end is None else end):
+            val = self.columns[i][row]
+            if self.numeric[i]:
+                if val != val:
+                    val = None
+                else:
+                    val = float(val)
+            values.append(val)
+        return values
+
+    def rows(self):
+        """Yields each row as a list of strings, the same way csv.reader would without the headers."""
+        for row in xrange(len(self)):
+            yield self.rowvalues(row, astext=True)
+
+
+def file_loadtable(inputfile, keycol=0, headers=True, filedelimiter=",", textcols=None, cache=False):
+    """Parses the inputfile once and returns a CsvTable that can be passed to the file_, csv_ and shp_joincsv functions in place of the inputfile path. keycol is the index of the join column. Set cache to True to keep a memory-mapped copy next to the inputfile that is reused while the inputfile is unchanged.
+    Default file delimiter is comma delimited but tab delimited can be used as well by specifiying '\t'.
+    """
+    return CsvTable(inputfile, keycol, headers, filedelimiter, textcols, cache)
+
+
+def _isnumber(val):
+    """Returns True if the string can be converted to a float."""
+    try:
+        float(val)
+        return True
+    except ValueError:
+        return False
+
+
+def _format_number(val):
+    """Formats a float from a CsvTable as csv text. nan is written as a blank and whole numbers without a decimal point."""
+    if val != val:
+        return ''
+    if float(val).is_integer() and abs(val) < 1e15:
+        return '%d' % val
+    return repr(float(val))
+
+
+def _file_rows(inputfile, filedelimiter=","):
+    """Yields every row of the inputfile, including the headers, as a list of strings. inputfile can be a path or a CsvTable. A CsvTable only yields headers if it was loaded with headers."""
+    if isinstance(inputfile, CsvTable):
+        if inputfile.hasheaders:
+            yield list(inputfile.headers)
+        for row in inputfile.rows():
+            yield row
+        return
+    with open(inputfile, 'rb') as csvdata:
+        for row in csv.reader(csvdata, delimiter=filedelimiter):
+            yield row
 
 
 def file_getcols(inputfile, filedelimiter=","):
-    """ Returns a list of the inputfile headers.
+    """ Returns a list of the inputfile headers. The inputfile can be a path or a CsvTable.
     Default file delimiter is comma delimited but tab delimited can be used as well by specifiying '\t'.
     """
+    if isinstance(inputfile, CsvTable):
+        return list(inputfile.headers)
     with open(inputfile, 'rb') as csvdata:
         cols = csv.reader(csvdata, delimiter=filedelimiter).next()
         return cols
 
 
-def file_sort(inputfile, colindex=0, reverse=False, headers=True, filedelimiter=","):
+def file_sort(inputfile, colindex=0, reverse=False, headers=True, filedelimiter=",", coltype="text", outputfile=None, memorylimit=64):
     """ Sorts an inputfile based on the colindex. If reverse is True, the values will be sorted in reverse index. Common file delimiters are comma ',' and tab '\t'.
 
+        coltype can be 'text' or 'double'. Text columns are compared as strings. Double columns are compared as numbers, so "20" sorts before "100". Values in a double column that are not numbers are sorted after the numbers.
+        To sort on more than one column, set colindex to a list of sort specs. Each spec is a column index or a tuple of (colindex, coltype) or (colindex, coltype, reverse). The coltype and reverse arguments are used for specs that do not set them. ie. colindex=[(2, 'double', True), 0] sorts by the third column as numbers from largest to smallest and then by the first column as text.
+        Files larger than memorylimit (in megabytes) are sorted in chunks on disk and merged, so very large files can be sorted. The sorted rows are written to a temporary file that replaces the outputfile once it is complete, so the inputfile is never left half written. The inputfile is replaced if no outputfile is given. Returns the path of the sorted file. The inputfile can also be a CsvTable, in which case the table's CSV is replaced if no outputfile is given.
+
         Default file format is comma delimited     """
-    with open(inputfile, 'rb') as csvdata:
-        csvinfo = csv.reader(csvdata, delimiter=filedelimiter)
-        if headers:
-            headers = csvinfo.next()
-        if reverse:
-            vals = sorted(csvinfo, key=operator.itemgetter(colindex), reverse=True)
-        else:
-            vals = sorted(csvinfo, key=operator.itemgetter(colindex))
-    with open(inputfile, 'wb') as outfile:
-        wr = csv.writer(outfile, delimiter=filedelimiter)
-        if headers:
-            wr.writerow(headers)
-        for l in vals:
-            wr.writerow(l)
+    if isinstance(inputfile, CsvTable):
+        headers = inputfile.hasheaders
+        filedelimiter = inputfile.filedelimiter
+    if outputfile is None:
+        outputfile = getattr(inputfile, 'path', inputfile)
+    outdir = os.path.dirname(os.path.abspath(outputfile))
+    sortkey = _sort_keyfunc(colindex, coltype, reverse)
+    csvinfo = _file_rows(inputfile, filedelimiter)
+    if headers:
+        headers = csvinfo.next()
+    handle, temppath = tempfile.mkstemp(suffix='.tmp', prefix=os.path.basename(outputfile) + '.', dir=outdir)
+    try:
+        with _stage('file_sort', file=outputfile) as stage:
+            rowcount = 0
+            with os.fdopen(handle, 'wb') as outfile:
+                wr = csv.writer(outfile, delimiter=filedelimiter)
+                if headers:
+                    wr.writerow(headers)
+                for l in _external_sort(csvinfo, sortkey, memorylimit, outdir):
+                    wr.writerow(l)
+                    rowcount += 1
+            stage.rows = rowcount
+            stage.bytes = os.path.getsize(temppath)
+    except:
+        os.remove(temppath)
+        raise
+    finally:
+        csvinfo.close()
+    _replace_file(temppath, outputfile)
     print "Finished sorting the inputfile"
+    return outputfile
+
+
+class _Descending(object):
+    """Wraps a sort key so that it sorts in reverse order inside a tuple of keys."""
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+    def __ne__(self, other):
+        return self.value != other.value
+
+
+def _double_key(val):
+    """Sort key for numeric csv values. Values that are not numbers sort after all numbers."""
+    try:
+        return (0, float(val))
+    except ValueError:
+        return (1, val)
+
+
+def _sort_keyfunc(colindex, coltype="text", reverse=False):
+    """Returns a key function for file_sort() from a column index or a list of sort specs."""
+    if not isinstance(colindex, list):
+        colindex = [colindex]
+    specs = []
+    for spec in colindex:
+        if not isinstance(spec, tuple):
+            spec = (spec,)
+        index = spec[0]
+        spectype = spec[1] if len(spec) > 1 else coltype
+        specreverse = spec[2] if len(spec) > 2 else reverse
+        if spectype.lower() == "double":
+            convert = _double_key
+        elif spectype.lower() == "text":
+            convert = None
+        else:
+            raise ValueError("Sort column type must be 'text' or 'double': " + str(spectype))
+        specs.append((index, convert, specreverse))
+
+    def sortkey(row):
+        keys = []
+        for index, convert, specreverse in specs:
+            val = row[index]
+            if convert:
+                val = convert(val)
+            if specreverse:
+                val = _Descending(val)
+            keys.append(val)
+        return keys
+    if len(specs) == 1:
+        index, convert, specreverse = specs[0]
+        if not convert and not specreverse:
+            return operator.itemgetter(index)
+        return lambda row: sortkey(row)[0]
+    return sortkey
+
+
+def _replace_file(source, destination):
+    """Renames source to destination, replacing destination if it exists. On Windows os.rename cannot replace a file, so MoveFileEx is used instead."""
+    if os.name == 'nt':
+        import ctypes
+        if not ctypes.windll.kernel32.MoveFileExW(unicode(source), unicode(destination), 0x1 | 0x8):  # MOVEFILE_REPLACE_EXISTING | MOVEFILE_WRITE_THROUGH
+            raise ctypes.WinError()
+    else:
+        os.rename(source, destination)
+
+
+_MERGE_FANIN = 64
+
+
+def _row_bytes(row):
+    """Returns a rough estimate of the memory used by a list of strings read by the csv module."""
+    size = 72 + 8 * len(row)
+    for val in row:
+        size += 38 + len(val)
+    return size
+
+
+def _external_sort(rows, sortkey, memorylimit=64, tempdir=None):
+    """Sorts an iterable of lists of strings by sortkey and returns an iterator over the sorted rows. Rows are held in memory until they use about memorylimit megabytes. After that, sorted chunks are written to temporary csv files in tempdir and merged lazily, so the rows never need to fit in memory. The sort is stable. Temporary files are deleted once the iterator is exhausted or closed."""
+    budget = memorylimit * 1024 * 1024
+    chunk = []
+    size = 0
+    chunkdir = None
+    paths = []
+    for row in rows:
+        chunk.append(row)
+        size += _row_bytes(row)
+        if size >= budget:
+            if chunkdir is None:
+                chunkdir = tempfile.mkdtemp(prefix='archelper_sort_', dir=tempdir)
+            chunk.sort(key=sortkey)
+            paths.append(_write_chunk(chunk, chunkdir))
+            chunk = []
+            size = 0
+    chunk.sort(key=sortkey)
+    if not paths:
+        return iter(chunk)
+    if chunk:
+        paths.append(_write_chunk(chunk, chunkdir))
+    del chunk
+    return _merge_chunks(paths, sortkey, chunkdir)
+
+
+def _write_chunk(chunk, chunkdir):
+    """Writes a sorted chunk of rows to a new temporary csv file and returns its path."""
+    handle, path = tempfile.mkstemp(suffix='.csv', dir=chunkdir)
+    with os.fdopen(handle, 'wb') as outfile:
+        csv.writer(outfile).writerows(chunk)
+    return path
+
+
+def _read_chunk(path, sortkey, chunkindex):
+    """Yields (key, chunkindex, row) tuples from a chunk file. The chunkindex keeps the merge stable and stops rows from being compared."""
+    with open(path, 'rb') as csvdata:
+        for row in csv.reader(csvdata):
+            yield (sortkey(row), chunkindex, row)
+
+
+def _merge_chunks(paths, sortkey, chunkdir):
+    """Merges sorted chunk files into one sorted iterator. When there are more than _MERGE_FANIN chunks, groups of chunks are first merged into larger chunk files so the number of open files stays bounded."""
+    try:
+        while len(paths) > _MERGE_FANIN:
+            merged = []
+            for start in xrange(0, len(paths), _MERGE_FANIN):
+                group = paths[start:start + _MERGE_FANIN]
+                handle, path = tempfile.mkstemp(suffix='.csv', dir=chunkdir)
+                with os.fdopen(handle, 'wb') as outfile:
+                    wr = csv.writer(outfile)
+                    for item in heapq.merge(*[_read_chunk(p, sortkey, i) for i, p in enumerate(group)]):
+                        wr.writerow(item[2])
+                for p in group:
+                    os.remove(p)
+                merged.append(path)
+            paths = merged
+        for item in heapq.merge(*[_read_chunk(p, sortkey, i) for i, p in enumerate(paths)]):
+            yield item[2]
+    finally:
+        shutil.rmtree(chunkdir, ignore_errors=True)
 
 
 def file_jointable(inputfile, workspace, delimiter):
     """ Imports the file to an arcgis geodatabase workspace and returns a string with the workspace and table name. The first row of data in a csv/txt file will be used for column headers.
 
-        File format options are csv, txt, dbf, xls, xlsx, OLE, INFO, VPF, personal/file/SDE geodtabase.
+        File format options are csv, txt, dbf, xls, xlsx, OLE, INFO, VPF, personal/file/SDE geodtabase. A CsvTable can be passed for its CSV path.
     """
+    if isinstance(inputfile, CsvTable):
+        inputfile = inputfile.path
     tablename = os.path.basename(inputfile)[:-4]
     try:
         arcpy.Delete_management(workspace + '//' + tablename)
@@ -117,19 +733,12 @@ def shp_getcols(shapefile):
     return mylist
 
 def shp_removecols(shapefile, cols):
-    """Removes fields from shapefile or geodatabase table specified in the cols list. Columns can only have 10 characters if a shapefile is being edited."""
-    for col in cols:
-        if shapefile[-4] == ".shp":
-            col = col[:10]
-        if arcpy.ListFields(shapefile, col):
-            arcpy.DeleteField_management(shapefile, col)
-            print 'Field deleted:', col
-        else:
-            print 'No field to delete:', col
+    """Removes fields from shapefile or geodatabase table specified in the cols list. Columns can only have 10 characters if a shapefile is being edited. All fields are removed with one DeleteField call, so the table is only rewritten once."""
+    shp_alterschema(shapefile, drop=cols)
 
 
 def shp_addcols(shapefile, cols, datatype):
-    """ Adds each column in the list of cols to the shapefile or geodatabase table. Columns can only have 10 characters in a shapefile. All columns added will be given the same datatype. If you try to add a duplicate column that is already in the shapefile, the existing duplicate column will be deleted.
+    """ Adds each column in the list of cols to the shapefile or geodatabase table. Columns can only have 10 characters in a shapefile. All columns added will be given the same datatype. If you try to add a duplicate column that is already in the shapefile, the existing duplicate column will be deleted. All of the columns are added with one shp_alterschema() call.
 
         Possible fields types:
 
@@ -155,42 +764,198 @@ def shp_addcols(shapefile, cols, datatype):
         For more info visit: http://desktop.arcgis.com/en/desktop/latest/manage-data/shapefiles/geoprocessing-considerations-for-shapefile-output.htm#GUID-A10ADA3B-0988-4AB1-9EBA-AD704F77B4A2
 
     """
-    if isinstance(cols, list):
-        for col in cols:
-            if shapefile[-4] == ".shp":
-                col = col[:10]
-            if arcpy.ListFields(shapefile, col):
-                print 'Removed existing column from the shapefile:', col
-                arcpy.DeleteField_management(shapefile, col)
-                arcpy.AddField_management(shapefile, col, datatype, field_is_nullable='NULLABLE')
-            else:
-                arcpy.AddField_management(shapefile, col, datatype, field_is_nullable='NULLABLE')
-            print 'Added column to the shapefile:', col, datatype
-    else:
-        if shapefile[-4] == ".shp":
+    if not isinstance(cols, list):
+        cols = [cols]
+    return shp_alterschema(shapefile, add=cols, datatype=datatype)
+
+
+def shp_alterschema(shapefile, add=None, drop=None, datatype="DOUBLE", replace=True, rebuild=False):
+    """Applies a set of field changes to a shapefile or geodatabase table in as few table rewrites as possible. Returns the list of field names that were added.
+
+        add is a list of field names or (name, datatype) tuples. Fields without a datatype get the datatype argument. drop is a list of field names to delete. If replace is True, fields in add that already exist are deleted and added again, the same as shp_addcols(). If replace is False, existing fields are kept as they are.
+        Shapefile field names are truncated to 10 characters before anything is changed. A ValueError is raised if two fields would end up with the same name, instead of one silently replacing the other. If a field that is added, replaced or dropped was written by a delta join, the delta join digests of the table are deleted (see shp_joincsv()).
+
+        Each DeleteField or AddField call rewrites the whole .dbf of a shapefile. All drops are made with one DeleteField call. If the AddFields tool is available (ArcGIS Pro), all adds are made with one AddFields call. Otherwise each field is added with its own AddField call.
+        Set rebuild to True to rewrite the table only once when AddFields is not available: an empty copy of the table is created, the schema changes are made on the empty copy, the rows are appended to it and the copy replaces the original. The original is renamed out of the way and only deleted once the copy has its name, and its attribute indexes and shapefile spatial index are added to the copy. The copy does not keep the metadata of the original and geodatabase ObjectIDs are numbered again, so only use it on tables where that does not matter.
+    """
+    isshp = _isshp(shapefile)
+    addfields = []
+    for col in add or []:
+        if isinstance(col, tuple):
+            col, coltype = col
+        else:
+            coltype = datatype
+        if isshp:
             col = col[:10]
-        if arcpy.ListFields(shapefile, col):
+        addfields.append((col, coltype))
+    dropfields = [col[:10] if isshp else col for col in drop or []]
+    seen = {}
+    for col, coltype in addfields:
+        if col.lower() in seen:
+            raise ValueError("More than one field would be named " + col + ". Shapefile field names are limited to 10 characters.")
+        seen[col.lower()] = col
+    existing = dict((field.name.lower(), field.name) for field in arcpy.ListFields(shapefile))
+    deletes = []
+    for col in dropfields:
+        if col.lower() in existing and existing[col.lower()] not in deletes:
+            deletes.append(existing[col.lower()])
+            print 'Field deleted:', col
+        else:
+            print 'No field to delete:', col
+    adds = []
+    for col, coltype in addfields:
+        if col.lower() in existing and existing[col.lower()] not in deletes:
+            if not replace:
+                continue
             print 'Removed existing column from the shapefile:', col
-            arcpy.DeleteField_management(shapefile, col)
-            arcpy.AddField_management(shapefile, col, datatype)
+            deletes.append(existing[col.lower()])
+        adds.append((col, coltype))
+    if adds or deletes:
+        _join_cleardigest(shapefile, [col for col, coltype in adds] + deletes)
+    with _stage('shp_alterschema', table=shapefile, added=len(adds), deleted=len(deletes)):
+        if not adds:
+            if deletes:
+                arcpy.DeleteField_management(shapefile, deletes)
+        elif hasattr(arcpy, 'AddFields_management'):
+            if deletes:
+                arcpy.DeleteField_management(shapefile, deletes)
+            arcpy.AddFields_management(shapefile, [[col, coltype] for col, coltype in adds])
+        elif rebuild:
+            _shp_rebuild(shapefile, deletes, adds)
         else:
-            arcpy.AddField_management(shapefile, col, datatype)
-        print 'Added column to the shapefile:', col, datatype
+            if deletes:
+                arcpy.DeleteField_management(shapefile, deletes)
+            for col, coltype in adds:
+                arcpy.AddField_management(shapefile, col, coltype)
+    for col, coltype in adds:
+        print 'Added column to the shapefile:', col, coltype
+    return [col for col, coltype in adds]
+
+
+def _replace_table(shapefile, temp):
+    """Replaces the shapefile or geodatabase table with the complete copy at temp. The original is renamed to a backup name and only deleted once the copy has been renamed to the original name. If that rename fails, the original is renamed back, the copy is deleted and the error is raised."""
+    backup = arcpy.CreateUniqueName(os.path.basename(shapefile), os.path.dirname(shapefile))
+    arcpy.Rename_management(shapefile, backup)
+    try:
+        arcpy.Rename_management(temp, shapefile)
+    except:
+        arcpy.Rename_management(backup, shapefile)
+        arcpy.Delete_management(temp)
+        raise
+    arcpy.Delete_management(backup)
+
+
+def _shp_rebuild(shapefile, deletes, adds):
+    """Rebuilds the shapefile or geodatabase table with the deletes removed and the adds added. The changes are made to an empty copy, so no rows are rewritten until the rows are appended. The original is replaced with _replace_table(). The attribute indexes on fields that are kept and the spatial index of a shapefile are added to the copy."""
+    desc = arcpy.Describe(shapefile)
+    indexes = [([field.name for field in index.fields], index.name, index.isUnique, index.isAscending) for index in arcpy.ListIndexes(shapefile)]
+    spatialindex = _isshp(shapefile) and os.path.exists(os.path.splitext(shapefile)[0] + '.sbn')
+    workspace = os.path.dirname(shapefile)
+    temp = arcpy.CreateUniqueName(os.path.basename(shapefile), workspace)
+    tempname = os.path.basename(temp)
+    if hasattr(desc, 'shapeType'):
+        arcpy.CreateFeatureclass_management(workspace, tempname, desc.shapeType, shapefile, "ENABLED" if desc.hasM else "DISABLED", "ENABLED" if desc.hasZ else "DISABLED", desc.spatialReference)
+    else:
+        arcpy.CreateTable_management(workspace, tempname, shapefile)
+    try:
+        if deletes:
+            arcpy.DeleteField_management(temp, deletes)
+        for col, coltype in adds:
+            arcpy.AddField_management(temp, col, coltype, field_is_nullable='NULLABLE')
+        fieldmappings = arcpy.FieldMappings()
+        fieldmappings.addTable(shapefile)
+        for col in deletes:
+            index = fieldmappings.findFieldMapIndex(col)
+            if index != -1:
+                fieldmappings.removeFieldMap(index)  # Replaced fields must start empty, so their old values are not copied.
+        arcpy.Append_management(shapefile, temp, 'NO_TEST', fieldmappings)
+    except:
+        arcpy.Delete_management(temp)
+        raise
+    _replace_table(shapefile, temp)
+    kept = dict((field.name.lower(), field) for field in arcpy.ListFields(shapefile) if field.type not in ('OID', 'Geometry'))
+    dropped = set(col.lower() for col in deletes)
+    for fields, name, unique, ascending in indexes:
+        if not fields or [field for field in fields if field.lower() not in kept or field.lower() in dropped]:
+            continue  # Indexes on the ObjectID, the shape or dropped fields are made by the copy or are no longer needed.
+        try:
+            arcpy.AddIndex_management(shapefile, fields, name, "UNIQUE" if unique else "NON_UNIQUE", "ASCENDING" if ascending else "NON_ASCENDING")
+        except Exception as e:
+            print "Could not add the index", name, "back to", shapefile + ":", e
+    if spatialindex:
+        arcpy.AddSpatialIndex_management(shapefile)
+
 
+def shp_stage(shapefile):
+    """Copies the shapefile or geodatabase table to the in_memory workspace and returns the path of the copy. Use the copy in place of the shapefile with shp_addcols(), shp_removecols(), shp_joincsv(), shp_jointable() and map_create1(), so all field changes and row updates are made in memory and the file on disk is not touched until shp_unstage() writes the copy back once. If a join fails part way, the file on disk is left as it was.
 
-def shp_joincsv(csvfile, shapefile, shapefilejoincol, csvjoinindex, csvstartfield, csvfieldtype="double", filedelimiter=",", csvendfield=None, usecustomlabel = False, customnodatalabel=-9999):
+        The copy has the same name as the shapefile, so map_create1() finds the same layers in the mxds and points them at the copy while the maps are exported. The mxds are not saved. Field names of copied shapefiles are still cut to 10 characters so the copy can be saved back. The in_memory workspace only exists in this process, so maps of a staged table are exported in one process.
+
+        staged = shp_stage('C:/Mapping_Project/Shapefiles/Counties.shp')
+        shp_joincsv(csvfile, staged, 'JOIN', 0, 1)
+        map_create1(mxds, staged, mapcols, 'Percent_Change')
+        shp_unstage(staged)  # or shp_unstage(staged, save=False) for a render only run
+    """
+    name = os.path.basename(shapefile)
+    if name[-4:].lower() == ".shp":
+        name = name[:-4]
+    staged = "in_memory/" + name
+    if staged in _staged_tables:
+        raise ValueError(shapefile + " can not be staged because " + _staged_tables[staged] + " is already staged as " + staged + ".")
+    with _stage('shp_stage', table=shapefile):
+        if hasattr(arcpy.Describe(shapefile), 'shapeType'):
+            arcpy.CopyFeatures_management(shapefile, staged)
+        else:
+            arcpy.CopyRows_management(shapefile, staged)
+    _staged_tables[staged] = shapefile
+    print "Staged", shapefile, "as", staged
+    return staged
+
+
+def shp_unstage(staged, save=True):
+    """Writes an in_memory copy made by shp_stage() back over the shapefile or geodatabase table it was copied from and deletes the copy. The copy is written next to the original first and only replaces it once it is complete. The original is renamed to a backup name until the written copy has its name, so there is always a complete table on disk. If the write fails, the original and the in_memory copy are both kept. Set save to False to delete the copy without writing anything to disk. Returns the path of the original."""
+    if staged not in _staged_tables:
+        raise ValueError(staged + " was not made by shp_stage().")
+    shapefile = _staged_tables[staged]
+    if save:
+        with _stage('shp_unstage', table=shapefile):
+            workspace = os.path.dirname(shapefile)
+            temp = arcpy.CreateUniqueName(os.path.basename(shapefile), workspace)
+            try:
+                if hasattr(arcpy.Describe(staged), 'shapeType'):
+                    arcpy.CopyFeatures_management(staged, temp)
+                else:
+                    arcpy.CopyRows_management(staged, temp)
+            except:
+                if arcpy.Exists(temp):
+                    arcpy.Delete_management(temp)
+                raise
+            _replace_table(shapefile, temp)
+        if staged in _staged_digests:
+            _json_save(*_staged_digests[staged])
+        print "Saved", staged, "to", shapefile
+    _staged_digests.pop(staged, None)
+    del _staged_tables[staged]
+    arcpy.Delete_management(staged)
+    return shapefile
+
+
+def shp_joincsv(csvfile, shapefile, shapefilejoincol, csvjoinindex, csvstartfield, csvfieldtype="double", filedelimiter=",", csvendfield=None, usecustomlabel = False, customnodatalabel=-9999, streaming=False, memorylimit=64, delta=False, editbatch=10000):
     """ This function manually joins the CSV to the shapefile and does not use geodatabase tables. This method should be easier and faster in most cases. In the CSV, the join column must be before the columns with mapping values. This code will map all fields from the mapping column onward (to the right). Headers of the csv will be used as field names and have a 10 character limit. Field names must not start with numbers either.
-        CSV field type can be 'double' or 'text'. If the fieldtype added is a double and there is no value, a a custom value of -9999 by default will be added. Arcpy automatically converts nulls to the values shown below, which is misleading. Use the customnodatalabel value and the symbology settings to represent no data. The default is -9999.
+        CSV field type can be 'double' or 'text'. If the fieldtype added is a double and there is no value, a a custom value of -9999 by default will be added. Arcpy automatically converts nulls to the values shown below, which is misleading. Use the customnodatalabel value and the symbology settings to represent no data. The default is -9999. Each shapefile row is written once with all of the joined fields. Returns a dictionary with the number of shapefile rows, matched rows and row writes.
 
         Shapefile null value substitution- Use a feature class to avoid this
             Number 0
             Text " "
             Date 0 but displays <null>
+
+        The csvfile can be a path or a CsvTable. A CsvTable is already in memory, so streaming is not used with it.
+        Set streaming to True for CSVs that are too big to hold in memory. The CSV rows and the shapefile join values are sorted on disk by the join value and merged in one pass, so memory use stays under memorylimit (in megabytes) no matter how big the CSV is. Temporary files are written to the system temp folder and removed when the join finishes. Geodatabase tables are read in ObjectID order. Shapefiles are read in their natural FID order.
+        Set delta to True for CSVs that are reissued with only some rows changed. A digest of the values joined to each join value is saved in a .joindigest file next to the shapefile (or next to the .gdb folder). When the next delta join has the same columns, field type and no data value, the existing fields are kept and only rows whose values changed are written. Otherwise the fields are added again and every row is written. The returned dictionary also has the number of rows 'inserted' (rows with a match that had none before), 'changed' and 'untouched'. shp_joincsv() without delta, shp_jointable(), shp_addcols() and shp_removecols() delete the digests when they add, replace or drop one of the delta joined fields, so the next delta join writes every row. Edits made by hand in ArcMap are not seen, so run a join with delta set to False after editing the joined fields by hand.
+        Geodatabase feature classes and tables (such as those in a create_workspace() geodatabase) are written in an arcpy.da.Editor edit session with an edit operation for every editbatch rows, instead of committing each row on its own. The throughput of each batch is printed and the returned dictionary has a 'batches' list with the 'rows', 'seconds' and 'rowspersecond' of each batch. If the join fails, every row edit is rolled back. Fields added by the join are kept. Set editbatch to None to write geodatabase tables without an edit session. Shapefiles always use a plain cursor.
         """
 
-    isshp = False
-    if shapefile[-4:] == ".shp":
-        isshp = True
+    isshp = _isshp(shapefile)
     cols = file_getcols(csvfile)
 
     i = 0
@@ -209,66 +974,764 @@ def shp_joincsv(csvfile, shapefile, shapefilejoincol, csvjoinindex, csvstartfiel
                 else:
                     newcols.append(col)
         i += 1
-    shp_addcols(shapefile, newcols, csvfieldtype)
-    i = 0
+    if usecustomlabel:
+        nodata = customnodatalabel
+    else:
+        nodata = None
+    digests = None
+    if delta:
+        digestpath = _sidecar_path(shapefile, '.joindigest')
+        digestmeta = json.loads(json.dumps({'columns': newcols, 'csvfieldtype': csvfieldtype.lower(), 'nodata': nodata, 'joincol': shapefilejoincol, 'streaming': bool(streaming) and not isinstance(csvfile, CsvTable)}))
+        state = _staged_digests.get(shapefile, (None, None))[1] or _json_load(digestpath)
+        existing = set(field.name.lower() for field in arcpy.ListFields(shapefile))
+        if state.get('meta') == digestmeta and not [col for col in newcols if col.lower() not in existing]:
+            digests = {'old': state['keys'], 'new': {}}
+        elif not state:
+            print "There is no previous delta join for", shapefile + ", so every row will be written."
+            digests = {'old': None, 'new': {}}
+        else:
+            print "The join columns are not the same as the last delta join, so every row will be written."
+            digests = {'old': None, 'new': {}}
+    if digests is None or digests['old'] is None:
+        shp_addcols(shapefile, newcols, csvfieldtype)
+    converters = _join_converters(csvfieldtype, len(newcols))
+    if isinstance(csvfile, CsvTable):
+        rowindex = csvfile.keyindex() if csvjoinindex == csvfile.keycol else dict((key, i) for i, key in reversed(list(enumerate(csvfile.text(csvjoinindex)))))
+        astext = csvfieldtype.lower() != "double"
+
+        def getvals(key):
+            row = rowindex.get(key)
+            if row is None:
+                return None
+            return csvfile.rowvalues(row, csvstartfield, csvstartfield + len(newcols), astext)
+        stats = _shp_writejoin(shapefile, shapefilejoincol, newcols, getvals, converters, nodata, digests=digests, editbatch=editbatch)
+    elif streaming:
+        stats = _shp_joincsv_streaming(csvfile, shapefile, shapefilejoincol, csvjoinindex, csvstartfield, newcols, converters, nodata, filedelimiter, memorylimit, digests, editbatch)
+    elif csvfieldtype.lower() == "double":
+        count = len(newcols)
+        rowindex, values, nanrows = _join_loadvalues(csvfile, csvjoinindex, csvstartfield, count, filedelimiter)
+
+        def getvals(key):
+            row = rowindex.get(key)
+            if row is None:
+                return None
+            vals = values[row * count:(row + 1) * count].tolist()
+            if row in nanrows:
+                vals = [nodata if val != val else val for val in vals]
+            return vals
+        stats = _shp_writejoin(shapefile, shapefilejoincol, newcols, getvals, None, nodata, digests=digests, editbatch=editbatch)
+    else:
+        with _stage('shp_joincsv.read_csv', file=csvfile) as stage:
+            with open(csvfile, 'rb') as csvdata:
+                lib = dict()
+                csvinfo = csv.reader(csvdata, delimiter=filedelimiter)
+                csvinfo.next()
+                rowcount = 0
+                for line in csvinfo:
+                    rowcount += 1
+                    if line[csvjoinindex] not in lib:
+                        lib[line[csvjoinindex]] = line[csvstartfield:csvstartfield + len(newcols)]
+                stage.rows = rowcount
+        stats = _shp_writejoin(shapefile, shapefilejoincol, newcols, lib.get, converters, nodata, digests=digests, editbatch=editbatch)
+    if digests is not None:
+        state = {'meta': digestmeta, 'keys': digests['new']}
+        if shapefile in _staged_tables:
+            _staged_digests[shapefile] = (digestpath, state)  # Saved by shp_unstage(), so the digests never describe values that were not saved.
+        else:
+            _json_save(digestpath, state)
+        print "Delta join:", stats['inserted'], "rows inserted,", stats['changed'], "rows changed and", stats['untouched'], "rows left untouched."
+    return stats
+
+
+def _sidecar_path(shapefile, extension):
+    """Returns the path of a file that archelper keeps for a shapefile or geodatabase table, such as the delta join digests. Shapefile files are saved next to the .shp file. Geodatabase table files are saved next to the .gdb folder with the table name. In memory copies from shp_stage() use the path of the table they were copied from."""
+    shapefile = _staged_tables.get(shapefile, shapefile)
+    gdbindex = shapefile.lower().find('.gdb')
+    if gdbindex != -1:
+        return shapefile[:gdbindex + 4] + '_' + os.path.basename(shapefile) + extension
+    return os.path.splitext(shapefile)[0] + extension
+
+
+def _join_cleardigest(shapefile, cols):
+    """Deletes the delta join digests of the shapefile or geodatabase table if any of the cols are fields written by the last delta join, so the next delta join does not trust values that were written by something else. Returns True if the digests were deleted."""
+    digestpath = _sidecar_path(shapefile, '.joindigest')
+    states = []
+    if shapefile in _staged_digests:
+        states.append(_staged_digests[shapefile][1])
+    if os.path.exists(digestpath):
+        states.append(_json_load(digestpath))
+    joined = set(col.lower() for state in states for col in state.get('meta', {}).get('columns', []))
+    if not joined & set(col.lower() for col in cols):
+        return False
+    _staged_digests.pop(shapefile, None)
+    if os.path.exists(digestpath):
+        os.remove(digestpath)
+    print "Removed the delta join digests of", shapefile, "because the joined fields were changed."
+    return True
+
+
+def _join_loadvalues(csvfile, csvjoinindex, csvstartfield, count, filedelimiter=","):
+    """Reads the join values of a double join into one array('d') buffer, so each value takes 8 bytes instead of a string object in a list per row. The values are converted to floats once while the CSV is read and each row takes count values in the buffer. Blank values and values that are not numbers are stored as nan, the no data value of the buffer. Only the first row of each join value is kept. Returns a dictionary of join value to row number, the buffer and the set of row numbers that have a nan."""
+    rowindex = {}
+    values = array.array('d')
+    nanrows = set()
+    nan = float('nan')
+    with _stage('shp_joincsv.read_csv', file=csvfile) as stage:
+        with open(csvfile, 'rb') as csvdata:
+            csvinfo = csv.reader(csvdata, delimiter=filedelimiter)
+            csvinfo.next()
+            rowcount = 0
+            for line in csvinfo:
+                rowcount += 1
+                key = line[csvjoinindex]
+                if key in rowindex:
+                    continue
+                vals = line[csvstartfield:csvstartfield + count]
+                try:
+                    vals = map(float, vals)
+                    if len(vals) < count:
+                        raise ValueError("Short row")
+                    if [val for val in vals if val != val]:
+                        nanrows.add(len(rowindex))
+                except ValueError:
+                    vals = [float(val) if _isnumber(val) else nan for val in vals] + [nan] * (count - len(vals))
+                    nanrows.add(len(rowindex))
+                rowindex[key] = len(rowindex)
+                values.extend(vals)
+            stage.rows = rowcount
+    return rowindex, values, nanrows
+
+
+def _join_converters(csvfieldtype, count):
+    """Returns a list with one value converter per joined column. The converter is chosen once from the csvfieldtype instead of for every cell."""
+    if csvfieldtype.lower() == "double":
+        converter = _join_float
+    else:
+        converter = str
+    return [converter] * count
 
-    with open(csvfile, 'rb') as csvfile:
-        lib = dict()
-        csvfile = csv.reader(csvfile, delimiter=filedelimiter)
-        csvfile.next()
-        for line in csvfile:
-            if csvendfield:
-                lib[line[csvjoinindex]] = lib.get(line[csvjoinindex], line[csvstartfield:csvendfield + 1])
-            else:
-                lib[line[csvjoinindex]] = lib.get(line[csvjoinindex], line[csvstartfield:])
-    rows = arcpy.da.UpdateCursor(shapefile)
-    shpjoinlist = []
-    for row in rows:
-        shpjoinval = str(row.getValue(shapefilejoincol))
-        shpjoinlist.append(shpjoinval)
-        try:
-            vals = lib.get(shpjoinval)
-        except:
-            if usecustomlabel:
-                for ind, field in enumerate(newcols):
-                    row.setValue(str(field), customnodatalabel)
-                    rows.updateRow(row)
-                continue
-            else:
-                continue
 
-        for ind, field in enumerate(newcols):
-            try:
-                if csvfieldtype.lower() == "double":
-                    row.setValue(str(field), float(vals[ind]))
-                elif csvfieldtype.lower() == "text":
-                    row.setValue(str(field), str(vals[ind]))
+def _join_float(val):
+    """Converts a joined value to a float. nan is the no data value of the join value stores, so it raises a ValueError and the row gets the no data value."""
+    val = float(val)
+    if val != val:
+        raise ValueError("No data")
+    return val
+
+
+def _shp_joincsv_streaming(csvfile, shapefile, shapefilejoincol, csvjoinindex, csvstartfield, newcols, converters, nodata, filedelimiter, memorylimit, digests=None, editbatch=None):
+    """The streaming join used by shp_joincsv(). The CSV rows and the shapefile (join value, ObjectID) pairs are sorted on disk by join value and merged to find the values for each ObjectID. The matches are sorted on disk by ObjectID and written in a single UpdateCursor pass. Each of the three sorts gets a third of memorylimit."""
+    sortlimit = memorylimit / 3.0
+    valuecount = len(newcols)
+    workdir = tempfile.mkdtemp(prefix='archelper_join_')
+    try:
+        def csvrows():
+            with open(csvfile, 'rb') as csvdata:
+                csvinfo = csv.reader(csvdata, delimiter=filedelimiter)
+                csvinfo.next()
+                for line in csvinfo:
+                    yield [line[csvjoinindex]] + line[csvstartfield:csvstartfield + valuecount]
+
+        def shprows():
+            with arcpy.da.SearchCursor(shapefile, [shapefilejoincol, 'OID@']) as rows:
+                for row in rows:
+                    yield [str(row[0]), str(row[1])]
+
+        def matches():
+            csvsorted = _external_sort(csvrows(), operator.itemgetter(0), sortlimit, workdir)
+            shpsorted = _external_sort(shprows(), operator.itemgetter(0), sortlimit, workdir)
+            csvline = next(csvsorted, None)
+            for shpkey, oid in shpsorted:
+                while csvline is not None and csvline[0] < shpkey:
+                    csvline = next(csvsorted, None)
+                if csvline is not None and csvline[0] == shpkey:
+                    yield [oid] + csvline[1:]
+
+        matchsorted = _external_sort(matches(), lambda line: int(line[0]), sortlimit, workdir)
+        current = [next(matchsorted, None)]
+
+        def getvals(oid):
+            oid = int(oid)
+            while current[0] is not None and int(current[0][0]) < oid:
+                current[0] = next(matchsorted, None)
+            if current[0] is not None and int(current[0][0]) == oid:
+                return current[0][1:]
+            return None
+
+        sql_clause = None
+        if shapefile[-4:].lower() != ".shp":
+            sql_clause = (None, 'ORDER BY ' + arcpy.Describe(shapefile).OIDFieldName)
+        return _shp_writejoin(shapefile, 'OID@', newcols, getvals, converters, nodata, sql_clause, digests, editbatch)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def _gdb_workspace(table):
+    """Returns the file geodatabase (.gdb) or enterprise connection (.sde) path of a geodatabase table, or None for shapefiles and in_memory tables."""
+    for extension in ('.gdb', '.sde'):
+        index = table.lower().find(extension)
+        if index != -1:
+            return table[:index + 4]
+    return None
+
+
+class _EditSession(object):
+    """Runs the row writes to a geodatabase table in an arcpy.da.Editor edit session. Call row() after each updateRow(). Every batchsize rows the edit operation is stopped and a new one started, and the rows, seconds and rows per second of the batch are printed and added to batches. The edits are saved when the with block ends. If it raises an error, the operation is aborted and the edit session is stopped without saving, so no rows are changed. Enterprise (.sde) workspaces are edited in multiuser mode so versioned tables can be written. For shapefiles, in_memory tables or a batchsize of None or 0 it does nothing."""
+
+    def __init__(self, table, batchsize):
+        self.table = table
+        self.batchsize = batchsize
+        self.workspace = _gdb_workspace(table) if batchsize else None
+        self.editor = None
+        self.batches = []
+        self.count = 0
+
+    def __enter__(self):
+        if self.workspace:
+            self.editor = arcpy.da.Editor(self.workspace)
+            self.editor.startEditing(False, self.workspace.lower().endswith('.sde'))
+            self._startbatch()
+        return self
+
+    def row(self):
+        if self.editor is None:
+            return
+        self.count += 1
+        if self.count >= self.batchsize:
+            self._stopbatch()
+            self._startbatch()
+
+    def _startbatch(self):
+        self.editor.startOperation()
+        self.count = 0
+        self.start = time.time()
+
+    def _stopbatch(self):
+        self.editor.stopOperation()
+        if not self.count:
+            return
+        seconds = time.time() - self.start
+        batch = {'rows': self.count, 'seconds': seconds, 'rowspersecond': self.count / seconds if seconds else None}
+        self.batches.append(batch)
+        print "Edit batch", len(self.batches), "of", self.table + ":", self.count, "rows in", round(seconds, 2), "seconds", "(" + str(int(batch['rowspersecond'] or 0)), "rows per second)."
+
+    def __exit__(self, exctype, value, traceback):
+        if self.editor is None:
+            return False
+        if exctype is not None:
+            self.editor.abortOperation()
+            self.editor.stopEditing(False)
+            print "The edits to", self.table, "were rolled back."
+            return False
+        with _stage('join.save_edits', table=self.table, batches=len(self.batches) + bool(self.count)):
+            self._stopbatch()
+            self.editor.stopEditing(True)
+        return False
+
+
+def _shp_writejoin(shapefile, shapefilejoincol, newcols, getvals, converters, nodata=None, sql_clause=None, digests=None, editbatch=None):
+    """Writes joined values to the newcols fields of the shapefile in a single UpdateCursor pass. getvals is called with the string join value of each row and returns the list of raw values, or None when there is no match. If converters is None, the values from getvals are written as they are. Every row is written exactly once. Values that cannot be converted and rows without a match are set to nodata. Returns a dictionary with the number of rows, matched rows and row writes.
+
+        digests is used by delta joins. It is a dictionary with the 'old' digests of the values joined to each join value by the last delta join, or None to write every row, and a 'new' dictionary that is filled with the digests of this join. Rows whose digest has not changed are not written. Rows without a match have no digest. The stats also count the rows 'inserted' (matched now but not last time), 'changed' and 'untouched'. Without old digests, every matched row counts as inserted and rows without a match are not counted.
+        Geodatabase tables are written in an edit session with an edit operation for every editbatch row writes (see _EditSession). The stats then have a 'batches' list. Shapefiles, in_memory tables and an editbatch of None or 0 use a plain UpdateCursor.
+    """
+    fieldcount = len(newcols)
+    nodatarow = [nodata] * fieldcount
+    stats = {'rows': 0, 'matched': 0, 'writes': 0}
+    if digests is not None:
+        olddigests = digests['old']
+        newdigests = digests['new']
+        stats.update({'inserted': 0, 'changed': 0, 'untouched': 0})
+    edits = _EditSession(shapefile, editbatch)
+    with edits:
+        if sql_clause:
+            rows = arcpy.da.UpdateCursor(shapefile, [shapefilejoincol] + list(newcols), sql_clause=sql_clause)
+        else:
+            rows = arcpy.da.UpdateCursor(shapefile, [shapefilejoincol] + list(newcols))
+        with _stage('join.update_rows', table=shapefile, fields=fieldcount) as stage, rows:
+            for row in rows:
+                stats['rows'] += 1
+                vals = getvals(str(row[0]))
+                if vals is None:
+                    row[1:] = nodatarow
+                elif converters is None:
+                    stats['matched'] += 1
+                    row[1:] = vals
                 else:
-                    row.setValue(str(field), str(vals[ind]))
-            except:
-##                print "Could not set value for:", shpjoinval, "for the field:", field
-                row.setValue(str(field), None)
-            rows.updateRow(row)
+                    stats['matched'] += 1
+                    for ind in xrange(fieldcount):
+                        try:
+                            row[ind + 1] = converters[ind](vals[ind])
+                        except (ValueError, TypeError, IndexError):
+    ##                        print "Could not set value for:", row[0], "for the field:", newcols[ind]
+                            row[ind + 1] = nodata
+                if digests is not None:
+                    key = str(row[0])
+                    digest = None
+                    if vals is not None:
+                        digest = newdigests[key] = hashlib.md5(repr(row[1:])).hexdigest()[:16]
+                    if olddigests is not None:
+                        olddigest = olddigests.get(key)
+                        if olddigest == digest:
+                            stats['untouched'] += 1
+                            continue
+                        elif olddigest is None:
+                            stats['inserted'] += 1
+                        else:
+                            stats['changed'] += 1
+                    elif vals is not None:
+                        stats['inserted'] += 1
+                rows.updateRow(row)
+                edits.row()
+                stats['writes'] += 1
+            stage.rows = stats['writes']
+    if edits.batches:
+        stats['batches'] = edits.batches
+    return stats
+
+
+def shp_jointable(injointable, injoinfield, combinedtable, combinedtablefield, fields, method="joinfield", addindexes=False, editbatch=10000):
+    """ Joins a workspace table to another workspace table or shapefile. The workspace table is generated by csv_jointable(). The jointable and shapefile variables should include the full file path ie. 'C:/path/to/shapefile.shp' or 'c:path/to/workspace.gbp/tablename'
+
+        The fields from the injointable replace any fields with the same name in the combinedtable. method can be 'joinfield' to use the Join Field tool or 'dictionary' to read the injointable once into a dictionary with a SearchCursor and write the values with a single UpdateCursor pass, which is much faster for large geodatabase tables. Set addindexes to True to add attribute indexes to both join fields when they are missing, which speeds up the Join Field tool on large tables. It changes both tables and needs a schema lock on them, so it is off by default. The dictionary method reads each table in one cursor pass and does not need the indexes. The dictionary method writes geodatabase tables in an edit session with an edit operation for every editbatch rows and rolls every edit back if the join fails, the same as shp_joincsv(). The time taken is printed. Returns a dictionary with the 'method', the 'seconds' taken and, for the dictionary method, the number of rows, matched rows and row writes.
+    """
+    start = time.time()
+    if addindexes:
+        shp_addindex(injointable, injoinfield)
+        shp_addindex(combinedtable, combinedtablefield)
+    if method.lower() == "dictionary":
+        stats = _shp_jointable_dictionary(injointable, injoinfield, combinedtable, combinedtablefield, fields, editbatch)
+    elif method.lower() == "joinfield":
+        new_fields = []
+        for col in fields:
+            if _isshp(combinedtable):
+                col = col[:10]
+            new_fields.append(col)
+        shp_alterschema(combinedtable, drop=new_fields)
+        arcpy.JoinField_management(combinedtable, combinedtablefield, injointable, injoinfield, fields)
+        stats = {}
+    else:
+        raise ValueError("The join method must be 'joinfield' or 'dictionary'.")
+    stats['method'] = method.lower()
+    stats['seconds'] = time.time() - start
+    print "Finished shapefile join with", stats['method'], "in", round(stats['seconds'], 2), "seconds."
+    return stats
+
 
-    del rows
-    return
+_FIELD_TYPES = {'String': 'TEXT', 'Single': 'FLOAT', 'Double': 'DOUBLE', 'SmallInteger': 'SHORT', 'Integer': 'LONG', 'Date': 'DATE', 'Guid': 'GUID', 'GlobalID': 'GUID', 'OID': 'LONG'}
 
 
-def shp_jointable(injointable, injoinfield, combinedtable, combinedtablefield, fields):
-    """ Joins a workspace table to another workspace table or shapefile. The workspace table is generated by csv_jointable(). The jointable and shapefile variables should include the full file path ie. 'C:/path/to/shapefile.shp' or 'c:path/to/workspace.gbp/tablename' """
-    new_fields = []
+def _shp_jointable_dictionary(injointable, injoinfield, combinedtable, combinedtablefield, fields, editbatch=None):
+    """The dictionary join used by shp_jointable(). The field types are copied from the injointable and the fields are added with one shp_alterschema() call."""
+    isshp = _isshp(combinedtable)
+    sourcefields = dict((field.name.lower(), field) for field in arcpy.ListFields(injointable))
+    adds = []
     for col in fields:
-        if combinedtable[-4:] == ".shp":
-            col = col[:10]
-        new_fields.append(col)
-        if arcpy.ListFields(combinedtable, col):
-            arcpy.DeleteField_management(combinedtable, col)
-    arcpy.JoinField_management(injointable, injoinfield, combinedtable, combinedtablefield, fields)
-    print "Finished shapefile join."
+        field = sourcefields[col.lower()]
+        adds.append((col[:10] if isshp else col, _FIELD_TYPES.get(field.type, 'TEXT')))
+    newcols = shp_alterschema(combinedtable, add=adds)
+    lib = dict()
+    with arcpy.da.SearchCursor(injointable, [injoinfield] + list(fields)) as rows:
+        for row in rows:
+            key = str(row[0])
+            if key not in lib:
+                lib[key] = row[1:]
+    return _shp_writejoin(combinedtable, combinedtablefield, newcols, lib.get, [_identity] * len(newcols), editbatch=editbatch)
+
+
+def _identity(val):
+    return val
+
+
+def shp_addindex(shapefile, field):
+    """Adds an attribute index on the field of a shapefile or geodatabase table if the field is not already indexed. Returns True if an index was added."""
+    for index in arcpy.ListIndexes(shapefile):
+        if [f.name.lower() for f in index.fields] == [field.lower()]:
+            return False
+    arcpy.AddIndex_management(shapefile, [field], (field + "_idx")[:30])
+    print "Added an attribute index to", shapefile, "on", field
+    return True
+
+
+def shp_maxmin_byfield(shapefile, shapejoincol, aggregation_column, maxmin_cols, percent_change=False, diff_lc=False, nodatavalue=-9999):
+    """This function will group the rows of a shapefile or geodatabase table by the 'aggregation_column' and find the maximum and minimum of each of the maxmin_cols in each group. A new field will be added to the shapefile that includes "L_" and the first 8 characters of each value in the maxmin_cols. In each group, the row with the maximum gets the maximum value in the new field and the row with the minimum gets the minimum, so the new columns can be used to label the max and min values when creating maps. Returns the new label columns. If percent_change = True, the labels will represent a percentage. If diff_lc is true, the labels will have 2 digits. Values equal to the nodatavalue (-9999 by default) and null values are left out.
+
+        All columns are read with one arcpy.da.TableToNumPyArray call and the labels are written with one UpdateCursor pass. Only labelled rows are written. shapejoincol is not needed to find the rows and is kept for older scripts.
+    """
+    newcols = ["L_" + col[:8] for col in maxmin_cols]
+    if _isshp(shapefile):
+        maxmin_cols = [col[:10] for col in maxmin_cols]
+    groups = _shp_groupmaxmin(shapefile, aggregation_column, maxmin_cols, nodatavalue, ['OID@'])
+    labels = {}
+    oids = groups['keys']['OID@']
+    for ind, col in enumerate(maxmin_cols):
+        values = groups['values'][col]
+        for rowind in itertools.chain(groups['min'][col], groups['max'][col]):  # The max is written last, so a group with one value is labelled with the max.
+            labels.setdefault(int(oids[rowind]), [None] * len(newcols))[ind] = _maxmin_label(values[rowind], percent_change, diff_lc)
+    newcols = shp_alterschema(shapefile, add=newcols, datatype="TEXT")
+    writes = 0
+    with _stage('shp_maxmin_byfield.update_rows', table=shapefile) as stage:
+        with arcpy.da.UpdateCursor(shapefile, ['OID@'] + newcols) as rows:
+            for row in rows:
+                vals = labels.get(row[0])
+                if vals is None:
+                    continue
+                for ind, val in enumerate(vals):
+                    if val is not None:
+                        row[ind + 1] = val
+                rows.updateRow(row)
+                writes += 1
+        stage.rows = writes
+    print newcols
+    return newcols
+
+
+def shp_maxmin_newshp(shapefile, shapejoincol, shapefile2, shapejoincol2, addcols, nodatavalue=-9999):
+    """This function adds max and min values associated with shapefile1 to shapefile2. shapejoincol is the column in shapefile that holds the shapefile2 join value in shapejoincol2. If shapefile 1 has 3 postcodes in a county, this script will add the max and min value to shapefile 2 for that county as a 'min% to max%' label in a text field with the same name as each of the addcols. The value -9999 in a shapefile is treated as unknown rather than a minimum change. Returns the new columns.
+
+        All addcols are read from shapefile with one arcpy.da.TableToNumPyArray call and shapefile2 is written with one UpdateCursor pass.
+    """
+    if _isshp(shapefile):
+        addcols = [col[:10] for col in addcols]
+    groups = _shp_groupmaxmin(shapefile, shapejoincol, addcols, nodatavalue)
+    labels = dict((str(key), [None] * len(addcols)) for key in groups['groups'])
+    for ind, col in enumerate(addcols):
+        values = groups['values'][col]
+        for rowind in groups['min'][col]:
+            labels[str(groups['group'][rowind])][ind] = str(int(round(values[rowind] * 100, 0))) + "% to "
+        for rowind in groups['max'][col]:
+            labels[str(groups['group'][rowind])][ind] += str(int(round(values[rowind] * 100, 0))) + "%"
+    newcols = shp_alterschema(shapefile2, add=addcols, datatype="TEXT")
+    writes = 0
+    with _stage('shp_maxmin_newshp.update_rows', table=shapefile2) as stage:
+        with arcpy.da.UpdateCursor(shapefile2, [shapejoincol2] + newcols) as rows:
+            for row in rows:
+                vals = labels.get(str(row[0]))
+                if vals is None:
+                    continue
+                row[1:] = vals
+                rows.updateRow(row)
+                writes += 1
+        stage.rows = writes
+    return newcols
+
+
+def _shp_groupmaxmin(shapefile, groupcol, cols, nodatavalue=-9999, keycols=None):
+    """Reads the groupcol, cols and keycols of the shapefile or geodatabase table in one arcpy.da.TableToNumPyArray call and finds the rows with the smallest and largest value of each column in each group. Values equal to the nodatavalue, nulls and NaN are left out, so a group with no values has no rows. Ties go to the first row for the minimum and the last row for the maximum. Returns a dictionary with:
+        groups: the sorted group values.
+        group: the group value of each row.
+        values: a dictionary of column to the array of row values.
+        keys: a dictionary of keycol to the array of row values.
+        min, max: dictionaries of column to the array of row numbers of the minimum and maximum of each group that has values.
+    """
+    if numpy is None:
+        raise ImportError("numpy is needed to find the max and min by group.")
+    keycols = list(keycols or [])
+    with _stage('groupmaxmin.read', table=shapefile) as stage:
+        data = arcpy.da.TableToNumPyArray(shapefile, [groupcol] + list(cols) + keycols, null_value=dict((col, nodatavalue) for col in cols))
+        stage.rows = len(data)
+    groups, inverse = numpy.unique(data[groupcol], return_inverse=True)
+    result = {'groups': groups, 'group': data[groupcol], 'values': {}, 'keys': dict((col, data[col]) for col in keycols), 'min': {}, 'max': {}}
+    for col in cols:
+        values = data[col].astype(numpy.float64)
+        rows = numpy.nonzero((values != nodatavalue) & ~numpy.isnan(values))[0]
+        rows = rows[numpy.lexsort((values[rows], inverse[rows]))]  # lexsort is stable, so equal values keep the table order.
+        rowgroups = inverse[rows]
+        change = rowgroups[1:] != rowgroups[:-1]
+        result['values'][col] = values
+        result['min'][col] = rows[numpy.concatenate(([True], change))] if len(rows) else rows
+        result['max'][col] = rows[numpy.concatenate((change, [True]))] if len(rows) else rows
+    return result
+
+
+def _maxmin_label(val, percent_change=False, diff_lc=False):
+    """Formats a max or min value for a label column."""
+    if percent_change:
+        return "{:.0%}".format(val)
+    elif diff_lc:
+        return "{:.2f}".format(val)
+    return str(val)
 
 
-def map_create1(mxds, shapefile, mapcols, symbology, labels=False, prefix=None, perchange_labels=False, LC_labels=False, mapresolution=600, nodatavalue=-9999):
-    """This function will create maps for all mxds specified and all fields in the mapcols list. Shapefile can be a shapefile or geodtabase table. The prefixed symbology options are 'Percent_Change' and 'Diff_LC' or importy symbology from  your own layer file. Labels can be set to True or False. If Diff_LC or Percent_change is specified, labels will be formatted accordingly. Use the prefix variable to add a prefix to the output file name. Using a prefix is strongly recommended when mapping multiple CSVs. """
+_LABEL_FORMATS = {'percent': lambda val: str(int(round(float(val) * 100, 0))) + '%',
+                  'fixed': lambda val: str(round(float(val), 3)),
+                  'raw': lambda val: _format_number(float(val))}
+
+
+def shp_labelcols(shapefile, mapcols, labelformat="raw", nodatavalue=-9999):
+    """Adds a text field for each of the mapcols with the label text for the column, so label classes can show the field instead of running a python expression for every feature at every export. The new fields are named "T_" and the column name, cut to 10 characters for shapefiles. If two label fields would get the same name, or a label field would have the name of a mapped column, a number is added to the end of the later one, ie. RP1000_GU and RP1000_GR are labelled in T_RP1000_G and T_RP1000_1. Returns a dictionary of column to label field.
+
+        labelformat is 'percent' (0.123 is labelled 12%), 'fixed' (rounded to 3 decimals) or 'raw'. Rows with the nodatavalue, nulls or values that are not numbers get a blank label, so no SQL query is needed to hide them. All label fields are added with one shp_alterschema() call and filled in one UpdateCursor pass. map_create1() calls this when precompute_labels is True.
+    """
+    if isinstance(mapcols, str):
+        mapcols = [mapcols]
+    if labelformat not in _LABEL_FORMATS:
+        raise ValueError("The label format must be one of: " + ", ".join(sorted(_LABEL_FORMATS)))
+    isshp = _isshp(shapefile)
+    if isshp:
+        mapcols = [col[:10] for col in mapcols]
+    mapcols = [col for ind, col in enumerate(mapcols) if col not in mapcols[:ind]]
+    labelcols = shp_alterschema(shapefile, add=_label_fieldnames(mapcols, isshp), datatype="TEXT")
+    formatter = _LABEL_FORMATS[labelformat]
+    count = len(mapcols)
+    writes = 0
+    with _stage('shp_labelcols.update_rows', table=shapefile, fields=count) as stage:
+        with arcpy.da.UpdateCursor(shapefile, list(mapcols) + labelcols) as rows:
+            for row in rows:
+                for ind in xrange(count):
+                    val = row[ind]
+                    label = ""
+                    if val is not None and val != nodatavalue:
+                        try:
+                            label = formatter(val)
+                        except (ValueError, TypeError):
+                            pass
+                    row[count + ind] = label
+                rows.updateRow(row)
+                writes += 1
+        stage.rows = writes
+    return dict(zip(mapcols, labelcols))
+
+
+def _label_fieldnames(mapcols, isshp):
+    """Returns the shp_labelcols() label field name for each of the mapcols. The names are unique and never the name of one of the mapcols."""
+    used = set(col.lower() for col in mapcols)
+    names = []
+    for col in mapcols:
+        base = "T_" + col
+        if isshp:
+            base = base[:10]
+        name = base
+        number = 1
+        while name.lower() in used:
+            suffix = str(number)
+            name = (base[:10 - len(suffix)] if isshp else base) + suffix
+            number += 1
+        used.add(name.lower())
+        names.append(name)
+    return names
+
+
+CLASSBREAK_METHODS = ('quantile', 'equal_interval', 'std_dev', 'jenks')
+
+
+def shp_classbreaks(shapefile, mapcols, method="jenks", numclasses=5, nodatavalue=-9999):
+    """Returns a dictionary of field name to class breaks for graduated symbology. All mapcols are read from the shapefile or geodatabase table in one arcpy.da.TableToNumPyArray call. Values equal to the nodatavalue and null values are left out. Columns are truncated to 10 characters for shapefiles.
+
+        Methods are 'quantile', 'equal_interval', 'std_dev' (one standard deviation per class, centred on the mean, so classes that fall outside the data are dropped) and 'jenks' (natural breaks). The breaks are a list of up to numclasses + 1 values starting with the minimum, the same format as classBreakValues in arcpy.mapping. Repeated breaks are dropped for every method, so a column with many equal values or a single value gets fewer classes. Pass the result to map_create1() with the classbreaks option to use them in maps.
+    """
+    if isinstance(mapcols, str):
+        mapcols = [mapcols]
+    if _isshp(shapefile):
+        mapcols = [col[:10] for col in mapcols]
+    data = arcpy.da.TableToNumPyArray(shapefile, mapcols, null_value=nodatavalue)
+    return _calc_classbreaks(dict((col, data[col]) for col in mapcols), method, numclasses, nodatavalue)
+
+
+def file_classbreaks(inputfile, mapcols, method="jenks", numclasses=5, nodatavalue=-9999, filedelimiter=","):
+    """Returns a dictionary of column name to class breaks like shp_classbreaks(), but reads the mapcols from the inputfile. The inputfile must have headers and can be a path or a CsvTable. Blank values and values that are not numbers are treated as no data.
+    Default file delimiter is comma delimited but tab delimited can be used as well by specifiying '\t'.
+    """
+    if isinstance(mapcols, str):
+        mapcols = [mapcols]
+    if isinstance(inputfile, CsvTable):
+        return _calc_classbreaks(dict((col, inputfile.column(col)) for col in mapcols), method, numclasses, nodatavalue)
+    with open(inputfile, 'rb') as csvdata:
+        csvinfo = csv.reader(csvdata, delimiter=filedelimiter)
+        headers = csvinfo.next()
+        indexes = [headers.index(col) for col in mapcols]
+        columns = [array.array('d') for col in mapcols]
+        for line in csvinfo:
+            for column, index in zip(columns, indexes):
+                try:
+                    column.append(float(line[index]))
+                except (ValueError, IndexError):
+                    column.append(nodatavalue)
+    return _calc_classbreaks(dict((col, numpy.frombuffer(column, dtype=numpy.float64)) for col, column in zip(mapcols, columns)), method, numclasses, nodatavalue)
+
+
+def _calc_classbreaks(columns, method, numclasses, nodatavalue):
+    """Calculates class breaks for a dictionary of column name to numpy array."""
+    if numpy is None:
+        raise ImportError("numpy is needed to calculate class breaks.")
+    method = method.lower()
+    if method not in CLASSBREAK_METHODS:
+        raise ValueError("Class break method must be one of: " + ", ".join(CLASSBREAK_METHODS))
+    breaks = {}
+    for col, values in columns.iteritems():
+        values = numpy.asarray(values, dtype=numpy.float64)
+        values = values[(values != nodatavalue) & numpy.isfinite(values)]
+        if not len(values):
+            breaks[col] = []
+            continue
+        if method == 'quantile':
+            colbreaks = numpy.unique(numpy.percentile(values, list(numpy.linspace(0, 100, numclasses + 1))))
+        elif method == 'equal_interval':
+            colbreaks = numpy.unique(numpy.linspace(values.min(), values.max(), numclasses + 1))
+        elif method == 'std_dev':
+            colbreaks = numpy.clip(values.mean() + values.std() * (numpy.arange(numclasses + 1) - numclasses / 2.0), values.min(), values.max())
+            colbreaks[0] = values.min()
+            colbreaks[-1] = values.max()
+            colbreaks = numpy.unique(colbreaks)
+        else:
+            colbreaks = _jenks_breaks(values, numclasses)
+        breaks[col] = [float(val) for val in colbreaks]
+    return breaks
+
+
+def _jenks_breaks(values, numclasses):
+    """Returns Jenks natural breaks for a numpy array. The optimal classes are found with dynamic programming on the sorted values. The best split point for each class count never decreases as the class end moves right, so each class count is solved by divide and conquer in O(n log n). Every level of the divide and conquer is evaluated for all open ranges at once with numpy."""
+    x = numpy.sort(values)
+    n = len(x)
+    numclasses = max(1, min(numclasses, len(numpy.unique(x))))
+    s1 = numpy.concatenate(([0.0], numpy.cumsum(x - x[0])))
+    s2 = numpy.concatenate(([0.0], numpy.cumsum((x - x[0]) ** 2)))
+
+    def cost(j, i):
+        """Sum of squared deviations of the sorted values x[j:i] for arrays of start j and end i."""
+        total = s1[i] - s1[j]
+        return (s2[i] - s2[j]) - total * total / (i - j)
+
+    ends = numpy.arange(n + 1)
+    previous = numpy.empty(n + 1)
+    previous[1:] = cost(numpy.zeros(n, dtype=numpy.int64), ends[1:])
+    splits = numpy.zeros((numclasses + 1, n + 1), dtype=numpy.int64)
+    for c in xrange(2, numclasses + 1):
+        current = numpy.empty(n + 1)
+        current[:c] = numpy.inf
+        lo = numpy.array([c])
+        hi = numpy.array([n])
+        optlo = numpy.array([c - 1])
+        opthi = numpy.array([n - 1])
+        while len(lo):
+            mid = (lo + hi) // 2
+            jhi = numpy.minimum(mid - 1, opthi)
+            lengths = jhi - optlo + 1
+            starts = numpy.concatenate(([0], numpy.cumsum(lengths)[:-1]))
+            task = numpy.repeat(numpy.arange(len(lo)), lengths)
+            j = optlo[task] + numpy.arange(lengths.sum()) - starts[task]
+            i = mid[task]
+            total = previous[j] + cost(j, i)
+            best = numpy.minimum.reduceat(total, starts)
+            first = numpy.flatnonzero(total == best[task])
+            tasks, firstindex = numpy.unique(task[first], return_index=True)
+            bestj = j[first[firstindex]]
+            current[mid] = best
+            splits[c, mid] = bestj
+            left = lo <= mid - 1
+            right = mid + 1 <= hi
+            lo, hi, optlo, opthi = (numpy.concatenate((lo[left], mid[right] + 1)), numpy.concatenate((mid[left] - 1, hi[right])),
+                                    numpy.concatenate((optlo[left], bestj[right])), numpy.concatenate((bestj[left], opthi[right])))
+        previous = current
+    uppers = []
+    end = n
+    for c in xrange(numclasses, 1, -1):
+        uppers.append(x[end - 1])
+        end = splits[c, end]
+    uppers.append(x[end - 1])
+    return [x[0]] + uppers[::-1]
+
+
+def mxd_getlist(folderpath="C:/Mapping_Project/MXDs"):
+    """ Returns a list of mxdfiles in the C:\Mapping_Project\MXDs folder"""
+    return glob(os.path.join(folderpath, "*.mxd"))
+
+
+def mxd_index(mxds=None, refresh=False):
+    """Returns the layer index for the mxds as a dictionary of mxd path to index entry. If mxds is None, all mxds in the C:/Mapping_Project/MXDs folder are indexed. Each entry has the mxd 'mtime' and 'size' and a list of 'dataframes'. Each data frame has a 'name' and a list of 'layers' with the layer 'name', 'index' in the data frame, 'dataSource' and whether the layer 'labelclasses' are supported.
+
+        The index is saved as mxd_index.json in the folder of each mxd. An mxd is only opened again when its size or modified time changes or when refresh is True, so looking up layers in many templates is fast after the first run.
+    """
+    if mxds is None:
+        mxds = mxd_getlist()
+    elif isinstance(mxds, str):
+        mxds = [mxds]
+    results = {}
+    folders = {}
+    for mxd in mxds:
+        folders.setdefault(os.path.dirname(os.path.abspath(mxd)), []).append(mxd)
+    for folder, folderfiles in folders.iteritems():
+        indexpath = os.path.join(folder, 'mxd_index.json')
+        index = _json_load(indexpath)
+        changed = False
+        for mxd in folderfiles:
+            key = os.path.basename(mxd).lower()
+            entry = index.get(key)
+            if refresh or not entry or entry['mtime'] != os.path.getmtime(mxd) or entry['size'] != os.path.getsize(mxd):
+                entry = _mxd_readindex(mxd)
+                index[key] = entry
+                changed = True
+            results[mxd] = entry
+        if changed:
+            _json_save(indexpath, index)
+    return results
+
+
+def _mxd_readindex(mxd):
+    """Opens the mxd and returns its index entry for mxd_index()."""
+    mxdobj = arcpy.mapping.MapDocument(mxd)
+    dataframes = []
+    for df in arcpy.mapping.ListDataFrames(mxdobj):
+        layers = []
+        for i, lyr in enumerate(arcpy.mapping.ListLayers(mxdobj, data_frame = df)):
+            datasource = None
+            if lyr.supports("DATASOURCE"):
+                datasource = lyr.dataSource
+            layers.append({'name': lyr.name, 'index': i, 'dataSource': datasource, 'labelclasses': lyr.supports("LABELCLASSES")})
+        dataframes.append({'name': df.name, 'layers': layers})
+    del mxdobj
+    return {'mtime': os.path.getmtime(mxd), 'size': os.path.getsize(mxd), 'dataframes': dataframes}
+
+
+def mxd_getlayers(mxds):
+    """Prints the available layers in the mxd document. A string version of the layer name is returned. mxd_getlayers(mxds = 'mxdpath' or ['mxdpath1','mxdpath2']). The layers are read from the mxd_index()."""
+    if isinstance(mxds, str):
+        mxds = [mxds]
+    index = mxd_index(mxds)
+    lyrlist = []
+    for mxdpath in mxds:
+        i = 0
+        for df in index[mxdpath]['dataframes']:
+            for lyr in df['layers']:
+                lyrlist.append([os.path.basename(mxdpath), str(lyr['name']), i])
+                i += 1
+    print 'MXD\tLAYER\tLAYER_INDEX'
+    for row in lyrlist:
+        print row
+    return lyrlist
+
+
+def mxd_findlayers(mxds, shapefile, dataframe=0):
+    """Returns a dictionary of mxd path to the indexes of the layers in the data frame that draw the shapefile or geodatabase table. Layers are matched by name the same way map_create1() matches them. Uses the mxd_index(), so no mxd is opened unless it has changed."""
+    if isinstance(mxds, str):
+        mxds = [mxds]
+    if shapefile[-4:] == ".shp":
+        layername = os.path.basename(shapefile).replace(".shp", "").lower()
+    else:
+        layername = os.path.basename(shapefile).lower()
+    index = mxd_index(mxds)
+    found = {}
+    for mxd in mxds:
+        dataframes = index[mxd]['dataframes']
+        if len(dataframes) > dataframe:
+            found[mxd] = [lyr['index'] for lyr in dataframes[dataframe]['layers'] if lyr['name'].lower() == layername]
+        else:
+            found[mxd] = []
+    return found
+
+
+def map_create1(mxds, shapefile, mapcols, symbology, labels=False, prefix=None, perchange_labels=False, LC_labels=False, mapresolution=600, nodatavalue=-9999, processes=1, incremental=False, rebuild=False, reportonly=False, classbreaks=None, precompute_labels=False, postprocess=None):
+    """This function will create maps for all mxds specified and all fields in the mapcols list. Shapefile can be a shapefile or geodtabase table. The prefixed symbology options are 'Percent_Change' and 'Diff_LC' or importy symbology from  your own layer file. Labels can be set to True or False. If Diff_LC or Percent_change is specified, labels will be formatted accordingly. Use the prefix variable to add a prefix to the output file name. Using a prefix is strongly recommended when mapping multiple CSVs. The prefix can also be a dictionary of mapcol to prefix, so columns joined from several CSVs can be mapped with one call.
+
+        Set processes to more than 1 to export the maps in parallel. The (mxd, field) jobs are split across a pool of worker processes and each worker opens its own copy of the mxd. The output file names are the same as in a single process run. Errors are collected instead of stopping the run. On Windows each worker imports the calling script again, so a script that calls map_create1() with processes must do its work under an if __name__ == '__main__': block. Otherwise every worker runs the whole script again (Function_Tester.py, for example, runs all of its code when it is imported).
+        classbreaks replaces the class breaks of the symbology layer for each field. It can be a dictionary of field name to breaks from shp_classbreaks() or file_classbreaks(), or one of the methods 'quantile', 'equal_interval', 'std_dev' or 'jenks' to calculate the breaks from the shapefile with the number of classes in the symbology layer. Fields without breaks keep the symbology layer breaks.
+        Before anything is read or written, the mxds, layers, mapped columns, symbology layer file and output folder are checked with map_plan() and a ValueError listing every problem is raised, so a bad column or layer name stops the run before the first map instead of part way through it.
+        Set precompute_labels to True with labels to write the label text of every mapped column to text fields with shp_labelcols() before any maps are made. The label classes then show those fields, so ArcMap does not run a python expression for each feature and no SQL query is needed to hide the nodatavalue. The label fields are added to the shapefile.
+        The shapefile can also be an in_memory copy made by shp_stage(). The layers are pointed at the copy while the maps are exported and the mxds are not saved.
+        postprocess is a dictionary of options for post-processing each jpg in background threads as soon as it is exported, while the next maps are made: 'quality' recompresses the jpg, 'thumbnail' writes a small copy to Out/thumbnails and 'contactsheet' is the path of a pdf of all the maps. See _PostExport for all the options. It needs PIL (Pillow). The results get 'postprocess_seconds', 'postprocess_error' and 'thumbnail' keys.
+        Set incremental to True to skip maps that have not changed since they were last exported. Each map gets a fingerprint made from the mxd and symbology layer file (size and modified time), the values in the mapped column, the label settings, the class breaks, the prefix and the resolution. Fingerprints are saved in export_manifest.json in the output folder and a map is skipped when its fingerprint matches and the jpg still exists. Set rebuild to True to export every map and refresh the manifest. Set reportonly to True to return the list of output paths that would be exported without making any maps. Without incremental that is every map.
+        Returns a list with one dictionary per map with the keys 'mxd', 'field', 'outpath', 'seconds', 'error' and 'skipped'. Exported maps also have 'layer_updates' and 'layer_updates_skipped', the number of layer settings changed and left as they were for the previous field.
+    """
 
     if isinstance(mxds, str):
         newmxd = []
@@ -278,209 +1741,985 @@ def map_create1(mxds, shapefile, mapcols, symbology, labels=False, prefix=None,
         newmapcols = []
         newmapcols.append(mapcols)
         mapcols = newmapcols
-    isshp = False
-    if shapefile[-4:] == ".shp":
-        isshp = True
+    isshp = _isshp(shapefile)
     newmapcols = []
     for col in mapcols:
         if isshp:
             col = col[:10]
         newmapcols.append(col)
+    if _map_symbologypath(symbology) is None:
+        print "You need to choose a valid symbology type: 'Percent_Change','Diff_LC', or a layerfile path"
+        return
+    problems, layers = _map_preflight(mxds, shapefile, mapcols, symbology, classbreaks)
+    if problems:
+        raise ValueError("The maps can not be made:\n" + "\n".join(problems))
+    symbpath = _map_symbology(symbology)
+    if isinstance(classbreaks, str):
+        numclasses = 5
+        if symbpath.symbologyType == "GRADUATED_COLORS":
+            numclasses = symbpath.symbology.numClasses
+        classbreaks = shp_classbreaks(shapefile, newmapcols, classbreaks, numclasses, nodatavalue)
+    elif classbreaks and isshp:
+        classbreaks = dict((col[:10], breaks) for col, breaks in classbreaks.iteritems())
+    if isinstance(prefix, dict) and isshp:
+        prefix = dict((col[:10], colprefix) for col, colprefix in prefix.iteritems())
+    staged = shapefile in _staged_tables
+    if staged and processes > 1:
+        print shapefile, "is staged in memory, so the maps will be exported in one process."
+        processes = 1
+    settings = {'shapefile': shapefile, 'isshp': isshp, 'symbology': symbology, 'labels': labels, 'prefix': prefix, 'perchange_labels': perchange_labels,
+                'LC_labels': LC_labels, 'mapresolution': mapresolution, 'nodatavalue': nodatavalue, 'layers': layers, 'classbreaks': classbreaks or {}, 'staged': staged, 'labelfields': {}}
+    if labels and precompute_labels and not reportonly:
+        if (symbology.lower() == "percent_change") or perchange_labels:
+            labelformat = "percent"
+        elif (symbology.lower() == "diff_lc") or LC_labels:
+            labelformat = "fixed"
+        else:
+            labelformat = "raw"
+        settings['labelfields'] = shp_labelcols(shapefile, newmapcols, labelformat, nodatavalue)
+    jobs = [(mxd, newmapcols) for mxd in mxds]
+    if reportonly and not incremental:
+        outpaths = [_map_outpath(mxd, field, prefix) for mxd, fields in jobs for field in fields]
+        print len(outpaths), "maps would be exported."
+        for outpath in outpaths:
+            print "Would export:", outpath
+        return outpaths
+    post = None
+    if postprocess and not reportonly:
+        post = _PostExport(postprocess)
+    results = []
+    try:
+        if incremental:
+            results = _map_create1_incremental(jobs, settings, symbpath, processes, rebuild, reportonly, post)
+        else:
+            results = _map_runjobs(jobs, settings, symbpath, processes, post)
+    finally:
+        if post:
+            post.close(results)
+    if not reportonly:
+        _map_savetimings(results, mapresolution)
+    return results
+
+
+_TIMINGS_PATH = 'C:/Mapping_Project/Out/export_timings.json'
+
+
+def map_plan(mxds, shapefile, mapcols, symbology, prefix=None, mapresolution=600, processes=1, classbreaks=None):
+    """Checks a map_create1() run without making any maps and prints the plan. Only the schema is read: the mxd_index() layers, the field names and types of the shapefile and the symbology layer file. It checks that every mxd and the symbology layer file exist, that every mxd has a layer for the shapefile, that every mapped column exists after it is cut to 10 characters for shapefiles, that two columns do not end up with the same name, that the columns are numbers for graduated colors symbology, that classbreaks is a known method and that the output folder exists.
+
+        The render time and jpg size of each map are estimated from past exports, which map_create1() saves in export_timings.json in the output folder. A map uses the timing of its own jpg, or else the average of the maps made with the same mxd, or else the average of all maps. Past timings are scaled by the number of pixels at mapresolution. The total time is divided by processes.
+        Returns a dictionary with the list of 'problems', the 'outputs' (one dictionary per map with the 'mxd', 'field', 'outpath' and estimated 'seconds' and 'bytes', which are None without past timings), the estimated total 'seconds' and 'bytes' and the number of maps 'unestimated'.
+    """
+    if isinstance(mxds, str):
+        mxds = [mxds]
+    if isinstance(mapcols, str):
+        mapcols = [mapcols]
+    isshp = _isshp(shapefile)
+    if _map_symbologypath(symbology) is None:
+        problems, layers = ["The symbology must be 'Percent_Change', 'Diff_LC' or a layer file path: " + symbology], {}
+    else:
+        problems, layers = _map_preflight(mxds, shapefile, mapcols, symbology, classbreaks)
+    if isinstance(prefix, dict) and isshp:
+        prefix = dict((col[:10], colprefix) for col, colprefix in prefix.iteritems())
+    history = _json_load(_TIMINGS_PATH)
+    outputs = []
+    for mxd in mxds:
+        for col in mapcols:
+            field = col[:10] if isshp else col
+            outpath = _map_outpath(mxd, field, prefix)
+            seconds, size = _map_estimate(history, outpath, mxd, mapresolution)
+            outputs.append({'mxd': mxd, 'field': field, 'outpath': outpath, 'seconds': seconds, 'bytes': size})
+    estimated = [output for output in outputs if output['seconds'] is not None]
+    plan = {'problems': problems, 'outputs': outputs, 'seconds': sum(output['seconds'] for output in estimated) / max(1, processes),
+            'bytes': sum(output['bytes'] for output in estimated), 'unestimated': len(outputs) - len(estimated)}
+    for output in outputs:
+        if output['seconds'] is None:
+            print "Will export:", output['outpath']
+        else:
+            print "Will export:", output['outpath'], "(about", round(output['seconds'], 1), "seconds and", round(output['bytes'] / 1048576.0, 1), "MB)"
+    print len(outputs), "maps at", mapresolution, "dpi. Estimated time:", round(plan['seconds'] / 60.0, 1), "minutes with", processes, "processes. Estimated size:", round(plan['bytes'] / 1048576.0, 1), "MB."
+    if plan['unestimated']:
+        print plan['unestimated'], "maps have no past timings and are not in the estimates."
+    for problem in problems:
+        print "Problem:", problem
+    if not problems:
+        print "No problems found."
+    return plan
+
+
+def _map_preflight(mxds, shapefile, mapcols, symbology, classbreaks=None):
+    """Runs the map_plan() checks. Returns the list of problems and the mxd_findlayers() dictionary for the mxds that exist."""
+    problems = []
+    isshp = _isshp(shapefile)
+    symbologypath = _map_symbologypath(symbology)
+    graduated = False
+    if not os.path.exists(symbologypath):
+        problems.append("The symbology layer file does not exist: " + symbologypath)
+    else:
+        graduated = _map_symbology(symbology).symbologyType == "GRADUATED_COLORS"
+    missingmxds = [mxd for mxd in mxds if not os.path.exists(mxd)]
+    for mxd in missingmxds:
+        problems.append("The mxd does not exist: " + mxd)
+    layers = mxd_findlayers([mxd for mxd in mxds if mxd not in missingmxds], shapefile)
+    missing = [mxd for mxd in mxds if mxd in layers and not layers[mxd]]
+    if missing:
+        problems.append("No layer named " + os.path.basename(shapefile).replace(".shp", "") + " in the first data frame of: " + ", ".join(missing))
+    if not arcpy.Exists(shapefile):
+        problems.append("The shapefile or table does not exist: " + shapefile)
+    else:
+        fields = dict((field.name.lower(), field) for field in arcpy.ListFields(shapefile))
+        names = {}
+        for col in mapcols:
+            name = col[:10] if isshp else col
+            if name.lower() in names:
+                problems.append("The columns " + names[name.lower()] + " and " + col + " both map the field " + name + ".")
+                continue
+            names[name.lower()] = col
+            if name.lower() not in fields:
+                if name != col:
+                    problems.append("The column " + col + " is cut to " + name + " in shapefiles and " + name + " is not in " + shapefile)
+                else:
+                    problems.append("The column " + col + " is not in " + shapefile)
+            elif graduated and fields[name.lower()].type not in ('Single', 'Double', 'SmallInteger', 'Integer'):
+                problems.append("The column " + name + " is a " + fields[name.lower()].type + " field. Graduated colors symbology needs a number field.")
+    if isinstance(classbreaks, str) and classbreaks not in CLASSBREAK_METHODS:
+        problems.append("The classbreaks method must be one of: " + ", ".join(CLASSBREAK_METHODS))
+    outfolder = 'C:/Mapping_Project/Out'
+    if not os.path.isdir(outfolder):
+        problems.append("The output folder does not exist: " + outfolder)
+    return problems, layers
+
+
+def _map_estimate(history, outpath, mxd, mapresolution):
+    """Returns the estimated (seconds, bytes) of a map from the export timings saved by map_create1(), or (None, None) if there are no timings to use."""
+    def scaled(entries):
+        entries = [(entry['seconds'] * (mapresolution / float(entry['mapresolution'])) ** 2, entry['bytes'] * (mapresolution / float(entry['mapresolution'])) ** 2) for entry in entries]
+        return sum(entry[0] for entry in entries) / len(entries), sum(entry[1] for entry in entries) / len(entries)
+
+    if outpath in history:
+        return scaled([history[outpath]])
+    for entries in ([entry for entry in history.itervalues() if entry['mxd'] == mxd], history.values()):
+        if entries:
+            return scaled(entries)
+    return None, None
+
+
+def _map_savetimings(results, mapresolution):
+    """Saves the export seconds and jpg size of the maps made without errors to the export timings used by map_plan()."""
+    results = [result for result in results if not result['error'] and not result['skipped'] and os.path.exists(result['outpath'])]
+    if not results:
+        return
+    history = _json_load(_TIMINGS_PATH)
+    for result in results:
+        history[result['outpath']] = {'mxd': result['mxd'], 'seconds': result['seconds'], 'bytes': os.path.getsize(result['outpath']), 'mapresolution': mapresolution}
+    _json_save(_TIMINGS_PATH, history)
+
+
+def _map_runjobs(jobs, settings, symbpath, processes=1, post=None):
+    """Exports the maps for a list of (mxd, fields) jobs in this process or in a process pool. Each exported jpg is submitted to post, a _PostExport, if it is given. Returns the list of result dictionaries."""
+    if processes > 1:
+        results = _map_create1_parallel(jobs, settings, processes, post)
+    else:
+        results = []
+        for mxd, fields in jobs:
+            results.extend(_map_renderfields(mxd, fields, settings, symbpath, post=post))
+    print "Layer updates made:", sum(result.get('layer_updates', 0) for result in results), "skipped:", sum(result.get('layer_updates_skipped', 0) for result in results)
+    return results
+
+
+def _map_create1_incremental(jobs, settings, symbpath, processes=1, rebuild=False, reportonly=False, post=None):
+    """Runs the map_create1() jobs with the export manifest. Maps with a matching fingerprint and an existing jpg are skipped unless rebuild is True. The manifest is updated for every map exported without errors, even when the run stops early."""
+    manifestpath = 'C:/Mapping_Project/Out/export_manifest.json'
+    manifest = _json_load(manifestpath)
+    digests = _column_digests(settings['shapefile'], sorted(set(field for mxd, fields in jobs for field in fields)))
+    fingerprints = {}
+    todo = []
+    skipped = []
+    for mxd, fields in jobs:
+        todofields = []
+        for field in fields:
+            outpath = _map_outpath(mxd, field, settings['prefix'])
+            fingerprints[outpath] = _map_fingerprint(mxd, field, settings, digests[field])
+            if not rebuild and manifest.get(outpath) == fingerprints[outpath] and os.path.exists(outpath):
+                skipped.append({'mxd': mxd, 'field': field, 'outpath': outpath, 'seconds': 0.0, 'error': None, 'skipped': True})
+            else:
+                todofields.append(field)
+        if todofields:
+            todo.append((mxd, todofields))
+    if reportonly:
+        outpaths = [_map_outpath(mxd, field, settings['prefix']) for mxd, fields in todo for field in fields]
+        print len(outpaths), "maps would be exported and", len(skipped), "maps are up to date."
+        for outpath in outpaths:
+            print "Would export:", outpath
+        return outpaths
+    print "Skipping", len(skipped), "maps that are up to date."
+    results = []
+    try:
+        results = _map_runjobs(todo, settings, symbpath, processes, post)
+    finally:
+        for result in results:
+            if not result['error']:
+                manifest[result['outpath']] = fingerprints[result['outpath']]
+        _json_save(manifestpath, manifest)
+    order = dict((outpath, i) for i, outpath in enumerate(_map_outpath(mxd, field, settings['prefix']) for mxd, fields in jobs for field in fields))
+    return sorted(results + skipped, key=lambda result: order[result['outpath']])
+
+
+def _file_stamp(path):
+    """Returns a string with the size and modified time of a file, or 'missing' if it does not exist."""
+    if not path or not os.path.exists(path):
+        return 'missing'
+    return '%d:%r' % (os.path.getsize(path), os.path.getmtime(path))
+
+
+def _column_digests(shapefile, fields):
+    """Reads the fields of the shapefile or geodatabase table in one cursor pass and returns a dictionary of field name to a sha1 digest of its values."""
+    hashes = [hashlib.sha1() for field in fields]
+    if fields:
+        with arcpy.da.SearchCursor(shapefile, list(fields)) as rows:
+            for row in rows:
+                for ind, val in enumerate(row):
+                    hashes[ind].update(repr(val) + '\n')
+    return dict((field, hashes[ind].hexdigest()) for ind, field in enumerate(fields))
+
+
+def _map_fingerprint(mxd, field, settings, columndigest):
+    """Returns the fingerprint of one map_create1() export from everything that changes the image."""
+    parts = [_file_stamp(mxd), _file_stamp(_map_symbologypath(settings['symbology'])), columndigest, field, settings['shapefile'], settings['symbology'].lower(),
+             settings['labels'], settings['perchange_labels'], settings['LC_labels'], settings['nodatavalue'], settings['prefix'].get(field) if isinstance(settings['prefix'], dict) else settings['prefix'], settings['mapresolution'],
+             settings['classbreaks'].get(field)]
+    if settings.get('labelfields', {}).get(field):
+        parts.append(settings['labelfields'][field])
+    return hashlib.sha1(json.dumps(parts)).hexdigest()
+
+
+def _json_load(path):
+    """Returns the dictionary saved in a json file such as the export manifest, or an empty dictionary if the file does not exist yet."""
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'rb') as infile:
+        return json.load(infile)
+
+
+def _json_save(path, data):
+    """Writes a dictionary to a temporary json file and replaces the old file with it."""
+    handle, temppath = tempfile.mkstemp(suffix='.tmp', dir=os.path.dirname(path))
+    with os.fdopen(handle, 'wb') as outfile:
+        json.dump(data, outfile, indent=1, sort_keys=True)
+    _replace_file(temppath, path)
+
+
+def _map_symbologypath(symbology):
+    """Returns the layer file path for the 'Percent_Change' or 'Diff_LC' options or a layer file path. Returns None if the symbology is not valid."""
     if symbology.lower() == "percent_change":
-        symbpath = arcpy.mapping.Layer("C:/Mapping_Project/MXDs/Symbology/PercentChange.lyr")
+        return "C:/Mapping_Project/MXDs/Symbology/PercentChange.lyr"
     elif symbology.lower() == "diff_lc":
-        symbpath = arcpy.mapping.Layer('C:/Mapping_Project/MXDs/Symbology/DifferenceinLossCost.lyr')
+        return 'C:/Mapping_Project/MXDs/Symbology/DifferenceinLossCost.lyr'
     elif symbology[-4:] == '.lyr':
-        symbpath = arcpy.mapping.Layer(symbology)
-    else:
+        return symbology
+    return None
+
+
+_symbology_cache = {}
+
+
+def _map_symbology(symbology):
+    """Returns the symbology layer for the 'Percent_Change' or 'Diff_LC' options or a layer file path. Returns None if the symbology is not valid. Loaded layers are cached by path and reloaded only when the layer file changes on disk."""
+    symbpath = _map_symbologypath(symbology)
+    if symbpath is None:
+        return None
+    mtime = None
+    if os.path.exists(symbpath):
+        mtime = os.path.getmtime(symbpath)
+    cached = _symbology_cache.get(symbpath)
+    if cached and cached[0] == mtime:
+        return cached[1]
+    layer = arcpy.mapping.Layer(symbpath)
+    _symbology_cache[symbpath] = (mtime, layer)
+    return layer
+
+
+def _map_outpath(mxd, field, prefix=None, region=None):
+    """Returns the output jpg path for a map of the field made with the mxd. prefix can be a string or a dictionary of field to prefix. Maps of a region made by map_create4() have the region before the field."""
+    if isinstance(prefix, dict):
+        prefix = prefix.get(field)
+    if region is not None:
+        field = str(region) + '_' + field
+    if prefix:
+        return 'C:/Mapping_Project/Out/' + prefix + '_' + os.path.basename(mxd).rstrip('.mxd') + '_' + field + '.jpg'
+    return 'C:/Mapping_Project/Out/' + os.path.basename(mxd).rstrip('.mxd') + '_' + field + '.jpg'
+
+
+def _layerstate_changed(state, key, value):
+    """Returns True if value is different from the last value applied to a layer for key and records the new value. state is a dictionary kept for each layer while its fields are exported."""
+    if key in state and state[key] == value:
+        return False
+    state[key] = value
+    return True
+
+
+def _map_renderfields(mxd, fields, settings, symbpath, catcherrors=False, post=None):
+    """Opens the mxd and exports one map for each of the fields. settings holds the map_create1() options. If catcherrors is True, an error is recorded in the result for the map instead of being raised. Each exported jpg is submitted to post, a _PostExport, if it is given. Returns a list of result dictionaries.
+
+        The symbology layer is applied once per layer. For each field only the layer settings that differ from the previous field are changed (value field, class breaks, label visibility, label expression and SQL query). The result for each map counts the layer updates made and skipped.
+    """
+    results = []
+    shapefile = settings['shapefile']
+    try:
+        with _stage('map_create1.open_mxd', mxd=mxd):
+            mxdobj = arcpy.mapping.MapDocument(mxd)
+            df = arcpy.mapping.ListDataFrames(mxdobj)[0]  # May need to change this to allow multiple dataframes in the future.
+            layers = arcpy.mapping.ListLayers(mxdobj, data_frame = df)
+        targets = [layers[i] for i in settings['layers'][mxd]]
+        if [lyr for lyr in targets if lyr.name.lower() != os.path.basename(shapefile).replace(".shp", "").lower()]:
+            raise ValueError("The layers in " + mxd + " changed after the mxd index was read.")
+        if settings.get('staged'):
+            for lyr in targets:
+                lyr.replaceDataSource(os.path.dirname(shapefile), "NONE", os.path.basename(shapefile), False)
+    except Exception as e:
+        if not catcherrors:
+            raise
+        return [{'mxd': mxd, 'field': field, 'outpath': _map_outpath(mxd, field, settings['prefix']), 'seconds': 0.0, 'error': repr(e), 'skipped': False} for field in fields]
+    for lyr in targets:
+        lyr.symbologyType == "GRADUATED_COLORS"
+        state = {}
+        for field in fields:
+            outpath = _map_outpath(mxd, field, settings['prefix'])
+            start = time.time()
+            result = {'mxd': mxd, 'field': field, 'outpath': outpath, 'seconds': 0.0, 'error': None, 'skipped': False, 'layer_updates': 0, 'layer_updates_skipped': 0}
+            try:
+                changes = _map_applyfield(df, lyr, field, state, settings, symbpath)
+                result['layer_updates'] = changes.count(True)
+                result['layer_updates_skipped'] = changes.count(False)
+                with _stage('map_create1.export', file=outpath) as stage:
+                    arcpy.RefreshActiveView()
+                    print "Making a map at:", outpath
+                    arcpy.mapping.ExportToJPEG(mxdobj, outpath, resolution=settings['mapresolution'])
+                    if os.path.exists(outpath):
+                        stage.bytes = os.path.getsize(outpath)
+                if post:
+                    post.submit(outpath)
+            except Exception as e:
+                if not catcherrors:
+                    raise
+                result['error'] = repr(e)
+                state.clear()
+            result['seconds'] = time.time() - start
+            results.append(result)
+    return results
+
+
+def _map_applyfield(df, lyr, field, state, settings, symbpath):
+    """Sets the symbology, value field, class breaks and labels of the layer for a map of the field. state is the layer state for _layerstate_changed(), so only the settings that differ from the previous field are changed. Returns a list with True for each layer setting changed and False for each one skipped."""
+    symbology = settings['symbology']
+    isshp = settings['isshp']
+    changes = []
+    with _stage('map_create1.update_layer', field=field):
+        if 'classBreakValues' in state and not settings['classbreaks'].get(field):
+            state.pop('symbology', None)  # The last field had custom breaks, so the layer file is applied again to get its own breaks back.
+        if _layerstate_changed(state, 'symbology', symbpath):
+            state.pop('valueField', None)
+            state.pop('classBreakValues', None)
+            arcpy.mapping.UpdateLayer(df, lyr, symbpath, True)  # if you get a value error, it could be because of the layers source symbology no longer being available. It could also be because of a join issue or incorrect column names. The column name character limit is 10 for shapefiles.
+            changes.append(True)
+        else:
+            changes.append(False)
+        changes.append(_layerstate_changed(state, 'valueField', field))
+        if changes[-1]:
+            lyr.symbology.valueField = field
+        if settings['classbreaks'].get(field):
+            changes.append(_layerstate_changed(state, 'classBreakValues', settings['classbreaks'][field]))
+            if changes[-1]:
+                lyr.symbology.classBreakValues = settings['classbreaks'][field]
+        changes.append(_layerstate_changed(state, 'showLabels', bool(settings['labels'])))
+        if changes[-1]:
+            lyr.showLabels = bool(settings['labels'])
+    with _stage('map_create1.labels', field=field):
+        if settings['labels']:
+            labelfield = settings['labelfields'].get(field)
+            if labelfield:
+                expres = "["+labelfield+"]"
+            elif (symbology.lower() == "percent_change") or (settings['perchange_labels']):
+                expres = "str(int(round(float(["+field+"])*100,0))) + '%'"
+            elif (symbology.lower() == "diff_lc") or (settings['LC_labels']):
+                expres = "str(round(float(["+field+"]),3))"
+            else:
+                expres = "["+field+"]"
+            sqlquery = None
+            if isshp and labelfield:
+                sqlquery = ""  # Nodata rows have a blank label, so the nodata query is cleared.
+            elif isshp:
+                sqlquery = field + " <> " + str(settings['nodatavalue'])
+            expchanged = _layerstate_changed(state, 'expression', expres)
+            sqlchanged = _layerstate_changed(state, 'SQLQuery', sqlquery)
+            changes.extend([expchanged, sqlchanged])
+            if expchanged or sqlchanged:
+                for lblClass in lyr.labelClasses:
+                    print lblClass, expres
+                    if expchanged:
+                        lblClass.expression = expres
+                    if sqlchanged and sqlquery is not None:
+                        lblClass.SQLQuery = sqlquery
+                    lblClass.showClassLabels = True
+    return changes
+
+
+def _map_worker(task):
+    """Runs one map_create1() job in a worker process. The task is (mxd, fields, settings). Errors are returned with the results so one bad map does not stop the pool."""
+    mxd, fields, settings = task
+    try:
+        symbpath = _map_symbology(settings['symbology'])
+    except Exception as e:
+        return [{'mxd': mxd, 'field': field, 'outpath': _map_outpath(mxd, field, settings['prefix']), 'seconds': 0.0, 'error': repr(e), 'skipped': False} for field in fields]
+    return _map_renderfields(mxd, fields, settings, symbpath, catcherrors=True)
+
+
+def _map_create1_parallel(jobs, settings, processes, post=None):
+    """Splits the (mxd, fields) jobs of map_create1() into tasks and runs them in a process pool. The fields of each mxd are split into about two tasks per process so each worker opens an mxd once per task. Results are returned in the same order as a single process run. The maps of each task are submitted to post, a _PostExport, as soon as the task finishes."""
+    if not jobs:
+        return []
+    taskspermxd = int(math.ceil(processes * 2.0 / len(jobs)))
+    tasks = []
+    for mxd, fields in jobs:
+        chunksize = max(1, int(math.ceil(len(fields) / float(taskspermxd))))
+        for start in xrange(0, len(fields), chunksize):
+            tasks.append((mxd, fields[start:start + chunksize], settings))
+    if os.name == 'nt' and not os.path.basename(sys.executable).lower().startswith('python'):
+        multiprocessing.set_executable(os.path.join(sys.exec_prefix, 'pythonw.exe'))  # Workers can not be started from ArcMap.exe.
+    pool = multiprocessing.Pool(min(processes, len(tasks)))
+    try:
+        with _stage('map_create1.parallel', processes=min(processes, len(tasks)), tasks=len(tasks)) as stage:
+            results = []
+            for taskresults in pool.imap(_map_worker, tasks, 1):
+                results.extend(taskresults)
+                if post:
+                    for result in taskresults:
+                        if not result['error']:
+                            post.submit(result['outpath'])
+            stage.rows = len(results)
+    finally:
+        pool.close()
+        pool.join()
+    errors = [result for result in results if result['error']]
+    print "Exported", len(results) - len(errors), "maps with", min(processes, len(tasks)), "processes."
+    for result in errors:
+        print "Could not export:", result['outpath'], result['error']
+    return results
+
+def shp_extentindex(shapefile, regioncol, padding=0.0, refresh=False):
+    """Returns a dictionary of each value in the regioncol of a shapefile or feature class to the extent of its features as [xmin, ymin, xmax, ymax]. All extents are found in one pass over the geometry. padding widens each extent by that fraction of its width and height on every side, so 0.05 leaves a 5% margin around the region.
+
+        The index is saved as a .extents file next to the shapefile (or next to the .gdb folder) and is only read again when the shapefile changes or refresh is True. Null region values are left out.
+    """
+    indexpath = _sidecar_path(shapefile, '.extents')
+    stamp = _table_mtime(_staged_tables.get(shapefile, shapefile))
+    index = _json_load(indexpath)
+    entry = index.get(regioncol)
+    if refresh or stamp is None or not entry or entry['stamp'] != stamp:
+        extents = {}
+        rowcount = 0
+        with _stage('shp_extentindex', table=shapefile) as stage:
+            with arcpy.da.SearchCursor(shapefile, [regioncol, 'SHAPE@']) as rows:
+                for region, shape in rows:
+                    rowcount += 1
+                    if region is None or shape is None:
+                        continue
+                    ext = shape.extent
+                    box = extents.get(region)
+                    if box is None:
+                        extents[region] = [ext.XMin, ext.YMin, ext.XMax, ext.YMax]
+                    else:
+                        box[0] = min(box[0], ext.XMin)
+                        box[1] = min(box[1], ext.YMin)
+                        box[2] = max(box[2], ext.XMax)
+                        box[3] = max(box[3], ext.YMax)
+            stage.rows = rowcount
+        entry = {'stamp': stamp, 'extents': [[region, box] for region, box in extents.iteritems()]}
+        if stamp is not None:
+            index[regioncol] = entry
+            _json_save(indexpath, index)
+    results = {}
+    for region, box in entry['extents']:
+        if isinstance(region, unicode):
+            region = str(region)
+        padx = (box[2] - box[0]) * padding
+        pady = (box[3] - box[1]) * padding
+        results[region] = [box[0] - padx, box[1] - pady, box[2] + padx, box[3] + pady]
+    return results
+
+
+def map_create4(mxds, shapefile, shpsubregioncol, mapcols, symbology, regions=None, labels=False, prefix=None, perchange_labels=False, LC_labels=False, mapresolution=300, nodatavalue=-9999, padding=0.05, coverlayers=None, filterlayer=True, classbreaks=None, precompute_labels=False, postprocess=None):
+    """This function will create one map for each region in the shpsubregioncol field of the shapefile, for all mxds specified and all fields in the mapcols list. The data frame is zoomed to each region with the extent from shp_extentindex(), so the geometry is read once for all regions and fields. regions is a list of the region values to map. All regions are mapped if it is None. padding is the margin around each region as a fraction of its size.
+
+        If filterlayer is True, the shapefile layer only draws the region being mapped. coverlayers is a list of the names of other layers in the mxd that draw everything except the region, such as a grey cover over the neighbouring regions. The symbology, labels, prefix, classbreaks, precompute_labels and postprocess options are the same as map_create1(). The output file names have the region before the field. The mxds are not saved.
+        Returns a list with one dictionary per map with the keys 'mxd', 'field', 'region', 'outpath', 'seconds' and 'error'. A map that fails is recorded and the other maps are still made.
+    """
+    if isinstance(mxds, str):
+        mxds = [mxds]
+    if isinstance(mapcols, str):
+        mapcols = [mapcols]
+    isshp = _isshp(shapefile)
+    if isshp:
+        mapcols = [col[:10] for col in mapcols]
+    if _map_symbologypath(symbology) is None:
         print "You need to choose a valid symbology type: 'Percent_Change','Diff_LC', or a layerfile path"
         return
+    problems, layers = _map_preflight(mxds, shapefile, mapcols, symbology, classbreaks)
+    if problems:
+        raise ValueError("The maps can not be made:\n" + "\n".join(problems))
+    symbpath = _map_symbology(symbology)
+    extents = shp_extentindex(shapefile, shpsubregioncol, padding)
+    if regions is None:
+        regions = sorted(extents)
+    missing = [region for region in regions if region not in extents]
+    if missing:
+        raise ValueError("No features in " + shapefile + " have the " + shpsubregioncol + " values: " + ", ".join(str(region) for region in missing))
+    if isinstance(classbreaks, str):
+        numclasses = 5
+        if symbpath.symbologyType == "GRADUATED_COLORS":
+            numclasses = symbpath.symbology.numClasses
+        classbreaks = shp_classbreaks(shapefile, mapcols, classbreaks, numclasses, nodatavalue)
+    elif classbreaks and isshp:
+        classbreaks = dict((col[:10], breaks) for col, breaks in classbreaks.iteritems())
+    settings = {'shapefile': shapefile, 'isshp': isshp, 'symbology': symbology, 'labels': labels, 'perchange_labels': perchange_labels, 'LC_labels': LC_labels,
+                'nodatavalue': nodatavalue, 'classbreaks': classbreaks or {}, 'labelfields': {}}
+    if labels and precompute_labels:
+        if (symbology.lower() == "percent_change") or perchange_labels:
+            labelformat = "percent"
+        elif (symbology.lower() == "diff_lc") or LC_labels:
+            labelformat = "fixed"
+        else:
+            labelformat = "raw"
+        settings['labelfields'] = shp_labelcols(shapefile, mapcols, labelformat, nodatavalue)
+    delimited = arcpy.AddFieldDelimiters(shapefile, shpsubregioncol)
+    regionfield = arcpy.ListFields(shapefile, shpsubregioncol)[0]
+    queries = {}
+    for region in regions:
+        if regionfield.type in ('String', 'Guid', 'Date'):
+            value = "'" + str(region).replace("'", "''") + "'"
+        else:
+            value = str(region)
+        queries[region] = (delimited + " = " + value, delimited + " <> " + value)
+    coverlayers = [name.lower() for name in coverlayers or []]
+    post = None
+    if postprocess:
+        post = _PostExport(postprocess)
+    results = []
+    try:
+        _map_create4_export(mxds, shapefile, mapcols, regions, extents, queries, layers, coverlayers, filterlayer, prefix, mapresolution, settings, symbpath, results, post)
+    finally:
+        if post:
+            post.close(results)
+    print "Exported", len([result for result in results if not result['error']]), "of", len(results), "region maps."
+    return results
+
+
+def _map_create4_export(mxds, shapefile, mapcols, regions, extents, queries, layers, coverlayers, filterlayer, prefix, mapresolution, settings, symbpath, results, post=None):
+    """Exports the map_create4() maps for every mxd, field and region and appends a result dictionary for each one to results. Each exported jpg is submitted to post, a _PostExport, if it is given."""
     for mxd in mxds:
-        mxdobj = arcpy.mapping.MapDocument(mxd)
-        df = arcpy.mapping.ListDataFrames(mxdobj)[0]  # May need to change this to allow multiple dataframes in the future.
-        for lyr in arcpy.mapping.ListLayers(mxdobj, data_frame = df):
-            if (lyr.name.lower() == os.path.basename(shapefile).replace(".shp", "").lower() and isshp) or (lyr.name.lower() == os.path.basename(shapefile).lower() and not isshp):
-                lyr.symbologyType == "GRADUATED_COLORS"
-                for field in newmapcols:
-                    arcpy.mapping.UpdateLayer(df, lyr, symbpath, True)  # if you get a value error, it could be because of the layers source symbology no longer being available. It could also be because of a join issue or incorrect column names. The column name character limit is 10 for shapefiles.
-                    lyr.symbology.valueField = field
-                    if labels:
-                        lyr.showLabels = True
-                        if (symbology.lower() == "percent_change") or (perchange_labels):
-                            expres = "str(int(round(float(["+field+"])*100,0))) + '%'"
-                        elif (symbology.lower() == "diff_lc") or (LC_labels):
-                            expres = "str(round(float(["+field+"]),3))"
-                        else:
-                            expres = "["+field+"]"
-                        for lblClass in lyr.labelClasses:
-                            print lblClass, expres
-                            lblClass.expression = expres
-                            if isshp:
-                                lblClass.SQLQuery = field + " <> " + str(nodatavalue)
-                            lblClass.showClassLabels = True
-                    else:
-                        lyr.showLabels = False
-                    arcpy.RefreshActiveView()
-                    if prefix:
-                        outpath = 'C:/Mapping_Project/Out/' + prefix + '_' + os.path.basename(mxd).rstrip('.mxd') + '_' + field + '.jpg'
+        with _stage('map_create4.open_mxd', mxd=mxd):
+            mxdobj = arcpy.mapping.MapDocument(mxd)
+            df = arcpy.mapping.ListDataFrames(mxdobj)[0]
+            mxdlayers = arcpy.mapping.ListLayers(mxdobj, data_frame = df)
+        targets = [mxdlayers[i] for i in layers[mxd]]
+        covers = [lyr for lyr in mxdlayers if lyr.name.lower() in coverlayers]
+        if shapefile in _staged_tables:
+            for lyr in targets:
+                lyr.replaceDataSource(os.path.dirname(shapefile), "NONE", os.path.basename(shapefile), False)
+        state = dict((id(lyr), {}) for lyr in targets)
+        for field in mapcols:
+            for region in regions:
+                outpath = _map_outpath(mxd, field, prefix, region)
+                start = time.time()
+                result = {'mxd': mxd, 'field': field, 'region': region, 'outpath': outpath, 'seconds': 0.0, 'error': None}
+                try:
+                    for lyr in targets:
+                        _map_applyfield(df, lyr, field, state[id(lyr)], settings, symbpath)  # Only changes the layer for the first region of each field.
+                    if filterlayer:
+                        for lyr in targets:
+                            lyr.definitionQuery = queries[region][0]
+                    for lyr in covers:
+                        lyr.definitionQuery = queries[region][1]
+                    df.extent = arcpy.Extent(*extents[region])
+                    with _stage('map_create4.export', file=outpath) as stage:
+                        arcpy.RefreshActiveView()
                         print "Making a map at:", outpath
-                    else:
-                        outpath = 'C:/Mapping_Project/Out/' + os.path.basename(mxd).rstrip('.mxd') + '_' + field + '.jpg'
-                        "Making a map at:", outpath
-                    arcpy.mapping.ExportToJPEG(mxdobj, outpath, resolution=mapresolution)
+                        arcpy.mapping.ExportToJPEG(mxdobj, outpath, resolution=mapresolution)
+                        if os.path.exists(outpath):
+                            stage.bytes = os.path.getsize(outpath)
+                    if post:
+                        post.submit(outpath)
+                except Exception as e:
+                    result['error'] = repr(e)
+                    print "Could not export:", outpath, result['error']
+                    for lyrstate in state.itervalues():
+                        lyrstate.clear()
+                result['seconds'] = time.time() - start
+                results.append(result)
+        del mxdobj
+
+
+_POSTPROCESS_DEFAULTS = {'quality': None, 'thumbnail': None, 'contactsheet': None, 'threads': 2, 'queuesize': 4,
+                         'sheetsize': (1240, 1754), 'sheetgrid': (3, 4), 'sheetresolution': 150}
+
+
+class _PostExport(object):
+    """Post-processes exported maps in a pool of threads while the next maps are made. submit() is called with each jpg as soon as it is exported and blocks while queuesize files are waiting, so memory use stays flat. close() waits for the queue to empty, finishes the contact sheet and adds the post-processing status to the map results.
+
+        The options are:
+        quality: recompresses each jpg in place with this JPEG quality (1-95).
+        thumbnail: writes a copy that fits in a square of this many pixels to a 'thumbnails' folder next to the jpg.
+        contactsheet: the path of a pdf with a page for every sheetgrid (columns, rows) maps, in the order the maps were exported. Each page is sheetsize pixels at sheetresolution dpi and is added to the pdf as soon as it is full.
+        threads, queuesize: the number of worker threads and the number of files that can wait for them.
+    """
+
+    def __init__(self, options):
+        if Image is None:
+            raise ImportError("PIL (Pillow) is needed to post-process exported maps.")
+        unknown = [key for key in options if key not in _POSTPROCESS_DEFAULTS]
+        if unknown:
+            raise ValueError("Unknown post-processing options: " + ", ".join(sorted(unknown)))
+        self.options = dict(_POSTPROCESS_DEFAULTS)
+        self.options.update(options)
+        self.queue = Queue.Queue(max(1, self.options['queuesize']))
+        self.lock = threading.Lock()
+        self.statuses = []
+        self.pending = {}
+        self.nextsheet = 0
+        self.page = None
+        self.pagecount = 0
+        self.slot = 0
+        if self.options['contactsheet'] and os.path.exists(self.options['contactsheet']):
+            os.remove(self.options['contactsheet'])
+        self.threads = [threading.Thread(target=self._work) for i in range(max(1, self.options['threads']))]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def submit(self, outpath):
+        """Queues an exported jpg. Blocks while the queue is full."""
+        with self.lock:
+            status = {'outpath': outpath, 'thumbnail': None, 'seconds': 0.0, 'error': None}
+            self.statuses.append(status)
+            seq = len(self.statuses) - 1
+        self.queue.put((seq, status))
+
+    def close(self, results=None):
+        """Waits for every queued file and saves the last contact sheet page. Each map result with a submitted outpath gets the keys 'postprocess_seconds', 'postprocess_error' and 'thumbnail'. Returns the list of file statuses."""
+        for thread in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        with self.lock:
+            self._savepage()
+        errors = [status for status in self.statuses if status['error']]
+        print "Post-processed", len(self.statuses) - len(errors), "of", len(self.statuses), "maps."
+        statuses = dict((status['outpath'], status) for status in self.statuses)
+        for result in results or []:
+            status = statuses.get(result['outpath'])
+            if status:
+                result['postprocess_seconds'] = status['seconds']
+                result['postprocess_error'] = status['error']
+                result['thumbnail'] = status['thumbnail']
+        return self.statuses
+
+    def _work(self):
+        while True:
+            task = self.queue.get()
+            if task is None:
+                return
+            seq, status = task
+            start = time.time()
+            sheetimage = None
+            try:
+                with _stage('postprocess', file=status['outpath']) as stage:
+                    sheetimage = self._process(status)
+                    stage.bytes = os.path.getsize(status['outpath'])
+            except Exception as e:
+                status['error'] = repr(e)
+            status['seconds'] = time.time() - start
+            with self.lock:
+                if status['error']:
+                    print "Could not post-process:", status['outpath'], status['error']
+                else:
+                    print "Post-processed", status['outpath'], "(" + str(seq + 1), "of", str(len(self.statuses)) + ")"
+                if self.options['contactsheet']:
+                    self.pending[seq] = (sheetimage, status)
+                    try:
+                        self._fillsheet()
+                    except Exception as e:
+                        print "Could not add to the contact sheet:", status['outpath'], repr(e)
+                        status['error'] = status['error'] or repr(e)
+
+    def _process(self, status):
+        """Recompresses the jpg and makes the thumbnail. Returns a small copy of the map for the contact sheet, or None if there is no contact sheet."""
+        outpath = status['outpath']
+        options = self.options
+        image = Image.open(outpath)
+        if options['quality']:
+            image.load()
+            temp = outpath + '.tmp'
+            image.save(temp, 'JPEG', quality=options['quality'], optimize=True, dpi=image.info.get('dpi', (72, 72)))
+            _replace_file(temp, outpath)
+        sheetsize = None
+        if options['contactsheet']:
+            columns, rows = options['sheetgrid']
+            sheetsize = (options['sheetsize'][0] // columns, options['sheetsize'][1] // rows - 20)
+        size = max(options['thumbnail'] or 0, max(sheetsize or (0,)))
+        if not size:
+            return None
+        if not options['quality']:
+            image.draft('RGB', (size, size))  # Decodes the jpg at a smaller scale, which is much faster for 600 dpi maps.
+        image = image.convert('RGB')
+        image.thumbnail((size, size), Image.ANTIALIAS)
+        if options['thumbnail']:
+            thumbdir = os.path.join(os.path.dirname(outpath), 'thumbnails')
+            if not os.path.isdir(thumbdir):
+                try:
+                    os.makedirs(thumbdir)
+                except OSError:
+                    pass  # Another thread made it.
+            thumb = image.copy()
+            thumb.thumbnail((options['thumbnail'], options['thumbnail']), Image.ANTIALIAS)
+            status['thumbnail'] = os.path.join(thumbdir, os.path.basename(outpath))
+            thumb.save(status['thumbnail'], 'JPEG', quality=85)
+        if sheetsize:
+            image.thumbnail(sheetsize, Image.ANTIALIAS)
+            return image
+        return None
+
+    def _fillsheet(self):
+        """Adds the finished maps to the contact sheet in the order they were submitted. Called with the lock held."""
+        columns, rows = self.options['sheetgrid']
+        cellwidth = self.options['sheetsize'][0] // columns
+        cellheight = self.options['sheetsize'][1] // rows
+        while self.nextsheet in self.pending:
+            image, status = self.pending.pop(self.nextsheet)
+            self.nextsheet += 1
+            if image is None:
+                continue
+            if self.page is None:
+                self.page = Image.new('RGB', self.options['sheetsize'], 'white')
+                self.slot = 0
+            left = (self.slot % columns) * cellwidth
+            top = (self.slot // columns) * cellheight
+            self.page.paste(image, (left + (cellwidth - image.size[0]) // 2, top))
+            ImageDraw.Draw(self.page).text((left + 5, top + cellheight - 18), os.path.basename(status['outpath']), fill='black')
+            self.slot += 1
+            if self.slot == columns * rows:
+                self._savepage()
+
+    def _savepage(self):
+        """Adds the current page to the contact sheet pdf. Called with the lock held."""
+        if self.page is None:
+            return
+        self.page.save(self.options['contactsheet'], 'PDF', resolution=self.options['sheetresolution'], append=self.pagecount > 0)
+        self.pagecount += 1
+        self.page = None
+
+
+_BATCH_DEFAULTS = {'mxds': None, 'shapefile': None, 'csv': None, 'mapcols': None, 'prefix': None, 'symbology': None, 'labels': False, 'perchange_labels': False,
+                   'LC_labels': False, 'mapresolution': 600, 'nodatavalue': -9999, 'processes': 1, 'incremental': False, 'rebuild': False, 'classbreaks': None,
+                   'precompute_labels': False, 'joincol': 'JOIN', 'csvjoinindex': 0, 'csvstartfield': 1, 'csvendfield': None, 'csvfieldtype': 'double',
+                   'filedelimiter': ',', 'usecustomlabel': False, 'customnodatalabel': -9999, 'streaming': False, 'memorylimit': 64, 'delta': False, 'editbatch': 10000}
+_BATCH_JOINKEYS = ('csv', 'shapefile', 'joincol', 'csvjoinindex', 'csvstartfield', 'csvendfield', 'csvfieldtype', 'filedelimiter', 'usecustomlabel', 'customnodatalabel', 'streaming', 'memorylimit', 'delta', 'editbatch')
+_BATCH_RENDERKEYS = ('shapefile', 'mxds', 'symbology', 'labels', 'perchange_labels', 'LC_labels', 'mapresolution', 'nodatavalue', 'classbreaks', 'processes', 'incremental', 'rebuild', 'precompute_labels')
+
+
+def map_batch(spec):
+    """Runs a whole set of CSV joins and map exports from a job spec. spec is a dictionary or the path of a json file (or a yaml file if PyYAML is installed). The spec has a list of 'jobs'. Every other key in the spec is a default for all jobs. Each job can have:
+        name: shown in the status table. The default is the CSV file name.
+        csv, shapefile: the CSV to join to the shapefile or geodatabase table with shp_joincsv(). Leave out csv to map columns already in the shapefile.
+        joincol, csvjoinindex, csvstartfield, csvendfield, csvfieldtype, filedelimiter, usecustomlabel, customnodatalabel, streaming, memorylimit, delta, editbatch: the shp_joincsv() options. joincol is the shapefile join column ('JOIN' by default).
+        mxds, mapcols, prefix, symbology, labels, perchange_labels, LC_labels, mapresolution, nodatavalue, classbreaks, processes, incremental, rebuild, precompute_labels: the map_create1() options. mapcols defaults to every joined column.
+        Set 'stage' to True in the spec to join and map in shp_stage() copies of the shapefiles. The copies are saved back once at the end unless 'save' is False. A copy is only saved if every join to that shapefile worked and the batch did not stop with an error. Otherwise the copy is deleted and the shapefile on disk is left as it was.
+
+        The jobs are planned before anything runs. Each CSV is joined once even if several jobs use it. Jobs are put in rounds so that two CSVs that add the same column to a shapefile are never joined before the first one is mapped. In each round every CSV is joined first and then the maps are made with one map_create1() call for each set of jobs with the same shapefile, mxds and map options, so each mxd is opened and its symbology applied once for all of the CSVs in the round. The columns of each CSV are kept together so the label settings change as little as possible between maps. The prefix of each job is kept for its own columns.
+
+        A job with a failed join is not mapped, and the other jobs still run. Prints a status table and returns a list with one dictionary per job with the keys 'name', 'round', 'join' ('ok', 'failed' or None), 'rows', 'matched', 'maps', 'skipped', 'errors', 'seconds', 'error' and 'saved' ('yes' or 'no' for staged shapefiles, otherwise None).
+
+        Example spec:
+        {"mxds": ["C:/Mapping_Project/MXDs/Europe.mxd"], "shapefile": "C:/Mapping_Project/Shapefiles/CRESTA.shp", "symbology": "Percent_Change", "labels": true,
+         "jobs": [{"csv": "C:/Mapping_Project/CSVs/Wind.csv", "prefix": "Wind"}, {"csv": "C:/Mapping_Project/CSVs/Flood.csv", "prefix": "Flood"}]}
+    """
+    if isinstance(spec, str):
+        with open(spec, 'rb') as specfile:
+            if spec[-5:].lower() == '.yaml' or spec[-4:].lower() == '.yml':
+                if yaml is None:
+                    raise ImportError("PyYAML is needed to read a yaml job spec.")
+                spec = yaml.safe_load(specfile)
+            else:
+                spec = json.load(specfile)
+    spec = _batch_str(spec)
+    defaults = dict(_BATCH_DEFAULTS)
+    defaults.update((key, val) for key, val in spec.iteritems() if key in _BATCH_DEFAULTS)
+    unknown = set(key for job in spec['jobs'] for key in job if key not in _BATCH_DEFAULTS and key != 'name')
+    if unknown:
+        raise ValueError("Unknown job spec keys: " + ", ".join(sorted(unknown)))
+    jobs = []
+    for job in spec['jobs']:
+        settings = dict(defaults)
+        settings.update(job)
+        if not settings['shapefile'] or not settings['mxds'] or not settings['symbology']:
+            raise ValueError("Every job needs a shapefile, mxds and symbology.")
+        if isinstance(settings['mxds'], str):
+            settings['mxds'] = [settings['mxds']]
+        name = job.get('name') or (os.path.basename(settings['csv']) if settings['csv'] else os.path.basename(settings['shapefile']))
+        jobs.append({'name': name, 'settings': settings, 'status': {'name': name, 'round': None, 'join': None, 'rows': 0, 'matched': 0, 'maps': 0, 'skipped': 0, 'errors': 0, 'seconds': 0.0, 'error': None, 'saved': None}})
+    staged = {}
+    if spec.get('stage'):
+        for job in jobs:
+            shapefile = job['settings']['shapefile']
+            if shapefile not in staged:
+                staged[shapefile] = shp_stage(shapefile)
+            job['settings']['shapefile'] = staged[shapefile]
+    finished = False
+    try:
+        rounds = _batch_plan(jobs)
+        for roundnum, roundjobs in enumerate(rounds):
+            _batch_runround(roundnum + 1, roundjobs)
+        finished = True
+    finally:
+        for shapefile, stagedpath in staged.iteritems():
+            shapefilejobs = [job for job in jobs if job['settings']['shapefile'] == stagedpath]
+            save = spec.get('save', True) and finished and not [job for job in shapefilejobs if job['status']['join'] == 'failed']
+            if spec.get('save', True) and not save:
+                print "The staged copy of", shapefile, "is not saved because", "a join failed." if finished else "the batch stopped with an error."
+            shp_unstage(stagedpath, save)
+            for job in shapefilejobs:
+                job['status']['saved'] = 'yes' if save else 'no'
+    statuses = [job['status'] for job in jobs]
+    print '%-30s %5s %6s %10s %10s %6s %7s %6s %9s %5s' % ('JOB', 'ROUND', 'JOIN', 'ROWS', 'MATCHED', 'MAPS', 'SKIPPED', 'ERRORS', 'SECONDS', 'SAVED')
+    for status in statuses:
+        print '%-30s %5s %6s %10d %10d %6d %7d %6d %9.1f %5s' % (status['name'][:30], status['round'], status['join'] or '-', status['rows'], status['matched'], status['maps'], status['skipped'], status['errors'], status['seconds'], status['saved'] or '-')
+        if status['error']:
+            print '    ', status['error']
+    return statuses
+
+
+def _batch_str(value):
+    """Converts the unicode strings that json returns to str, because the archelper functions check for str."""
+    if isinstance(value, unicode):
+        return str(value)
+    elif isinstance(value, list):
+        return [_batch_str(val) for val in value]
+    elif isinstance(value, dict):
+        return dict((_batch_str(key), _batch_str(val)) for key, val in value.iteritems())
+    return value
+
+
+def _batch_columns(settings):
+    """Returns the columns a map_batch() job joins and the columns it maps, cut to 10 characters for shapefiles."""
+    joined = []
+    if settings['csv']:
+        joined = file_getcols(settings['csv'], settings['filedelimiter'])[settings['csvstartfield']:settings['csvendfield']]
+    mapcols = settings['mapcols'] or joined
+    if isinstance(mapcols, str):
+        mapcols = [mapcols]
+    if _isshp(settings['shapefile']):
+        joined = [col[:10] for col in joined]
+        mapcols = [col[:10] for col in mapcols]
+    return joined, mapcols
+
+
+def _batch_plan(jobs):
+    """Puts the map_batch() jobs in rounds. A job goes in the first round where no job with a different join adds or maps one of its columns in the same shapefile. Jobs with a CSV that can not be read are marked as failed and left out. Returns the list of rounds."""
+    rounds = []
+    for job in jobs:
+        settings = job['settings']
+        try:
+            job['joined'], job['mapcols'] = _batch_columns(settings)
+        except (IOError, OSError) as e:
+            job['status'].update({'join': 'failed', 'error': "Could not read the CSV: " + repr(e)})
+            continue
+        job['joinkey'] = json.dumps([settings[key] for key in _BATCH_JOINKEYS]) if settings['csv'] else None
+        columns = set(col.lower() for col in job['joined'] + job['mapcols'])
+        for roundjobs in rounds:
+            if not [other for other in roundjobs if other['settings']['shapefile'] == settings['shapefile'] and other['joinkey'] != job['joinkey'] and (job['joinkey'] or other['joinkey'])
+                    and columns.intersection(col.lower() for col in other['joined'] + other['mapcols'])]:
+                roundjobs.append(job)
+                break
+        else:
+            rounds.append([job])
+    return rounds
+
+
+def _batch_runround(roundnum, jobs):
+    """Joins each CSV of a map_batch() round once and then makes the maps with one map_create1() call per group of jobs with the same shapefile, mxds and map options."""
+    joins = {}
+    for job in jobs:
+        job['status']['round'] = roundnum
+        settings = job['settings']
+        if not job['joinkey']:
+            continue
+        start = time.time()
+        if job['joinkey'] not in joins:
+            try:
+                joins[job['joinkey']] = shp_joincsv(settings['csv'], settings['shapefile'], settings['joincol'], settings['csvjoinindex'], settings['csvstartfield'], settings['csvfieldtype'],
+                                                    settings['filedelimiter'], settings['csvendfield'], settings['usecustomlabel'], settings['customnodatalabel'], settings['streaming'],
+                                                    settings['memorylimit'], settings['delta'], settings['editbatch'])
+            except Exception as e:
+                joins[job['joinkey']] = e
+        result = joins[job['joinkey']]
+        job['status']['seconds'] += time.time() - start
+        if isinstance(result, Exception):
+            job['status']['join'] = 'failed'
+            job['status']['error'] = "Join failed: " + repr(result)
+        else:
+            job['status'].update({'join': 'ok', 'rows': result['rows'], 'matched': result['matched']})
+    groups = []
+    for job in jobs:
+        if job['status']['join'] == 'failed':
+            continue
+        key = json.dumps([job['settings'][name] for name in _BATCH_RENDERKEYS])
+        for group in groups:
+            if group['key'] == key and not [col for col in job['mapcols'] if col in group['prefix'] and group['prefix'][col] != job['settings']['prefix']]:
+                break
+        else:
+            group = {'key': key, 'settings': job['settings'], 'jobs': [], 'mapcols': [], 'prefix': {}, 'owner': {}}
+            groups.append(group)
+        group['jobs'].append(job)
+        for col in job['mapcols']:
+            if col not in group['prefix']:
+                group['mapcols'].append(col)
+                group['prefix'][col] = job['settings']['prefix']
+                group['owner'][col] = job
+    for group in groups:
+        settings = group['settings']
+        start = time.time()
+        try:
+            results = map_create1(settings['mxds'], settings['shapefile'], group['mapcols'], settings['symbology'], settings['labels'], group['prefix'], settings['perchange_labels'],
+                                  settings['LC_labels'], settings['mapresolution'], settings['nodatavalue'], settings['processes'], settings['incremental'], settings['rebuild'],
+                                  classbreaks=settings['classbreaks'], precompute_labels=settings['precompute_labels'])
+        except Exception as e:
+            for job in group['jobs']:
+                job['status']['error'] = "Maps failed: " + repr(e)
+                job['status']['errors'] += len(job['mapcols']) * len(settings['mxds'])
+            continue
+        finally:
+            seconds = time.time() - start
+            mapcount = float(max(1, len(group['mapcols'])))
+            for job in group['jobs']:
+                job['status']['seconds'] += seconds * len([col for col in group['mapcols'] if group['owner'][col] is job]) / mapcount
+        if results is None:
+            for job in group['jobs']:
+                job['status']['error'] = "Maps failed: the symbology is not valid."
+            continue
+        for result in results:
+            status = group['owner'][result['field']]['status']
+            if result['error']:
+                status['errors'] += 1
+            elif result['skipped']:
+                status['skipped'] += 1
+            else:
+                status['maps'] += 1
 
-# def shp_maxmin_newshp(shapefile, shapejoincol, shapefile2, shapejoincol2, addcols):
-#     """Not using this function for the project, but it works, so i'm leaving it here. This function adds max and min values associated with shapefile1 to shapefile2. If shapefile 1 has 3 postcodes in a county, this script will add the max and min value to shapefile 2 for that county. The value -9999 in a shapefile is treated as unknown rather than a minimum change."""
-#     i= 0
-#     for col in addcols:
-#         addcols[i] = col[:10]
-#         i += 1
-#     i = 0
-#     shp_addcols(shapefile2, addcols, "STRING")
-#     rows = arcpy.da.SearchCursor(shapefile)
-#     shpvallist = []
-#     joinlist = []
-#     for row in rows:
-#         vals = {}
-#         vals[shapejoincol2] = row.getValue(shapejoincol2)
-#         joinlist.append(vals[shapejoincol2])
-#         for val in addcols:
-#             vals[val] = float(row.getValue(val))
-#         shpvallist.append(vals)
-
-#     joinlist = set(joinlist)
-#     coldict = {}
-#     for col in addcols:
-#         newdict = {}
-#         for adminval in joinlist:
-#             vals = []
-#             for row in shpvallist:
-#                 if row[shapejoincol2] == adminval:
-#                     if int(row[col]) == -9999: #use -9999 as a key for no data
-#                         vals.append('')
-#                     else:
-#                         vals.append(row[col])
-#             try:
-#                 maxval = max(v for v in vals if v <> '')
-#             except:
-#                 maxval = "None"
-#             try:
-#                 minval = min(vals)
-#             except:
-#                 minval = "None"
-#             maxval = str(int(round(maxval *100,0)))
-#             minval = str(int(round(minval *100,0)))
-#             newdict[adminval] = minval + "% to "+ maxval + "%"
-#         coldict[col] = newdict
-
-#     for col in addcols:
-#         vals = coldict[col]
-#         del rows
-#         rows = arcpy.da.UpdateCursor(shapefile2)
-#         for row in rows:
-#             shpjoinval = row.getValue(shapejoincol2)
-#             try:
-#                 row.setValue(str(col),str(vals[shpjoinval]))
-#                 rows.updateRow(row)
-#             except:
-#                 pass
-
-# def shp_maxmin_byfield(shapefile, shapejoincol, aggregation_column, maxmin_cols, percent_change = False, diff_lc = False):
-#     """This function will loop through a shapefile and group values based upon the specified 'aggregation_column'. The function will then calculate the maximum and minimum for each of the maxmin_cols specified. A new field will be added to the shapefile that includes "L_" and the first 8 characters of each value in the maxmin_cols. Use these new columns to label the max and min values when creating maps. Returns the new label columns. If percent_change = True, the labels will represent a percentage. If diff_lc is true, the labels will have 2 digits."""
-#     newcols = []
-#     for col in maxmin_cols:
-#         newcols.append("L_" + col[:8])
-#     shp_addcols(shapefile, newcols, "STRING")
-#     for col in maxmin_cols:
-#         col =  col[:10]
-#         rows = arcpy.da.UpdateCursor(shapefile)
-#         shpvallist = []
-#         for row in rows:
-#             adminval = row.getValue(aggregation_column)
-#             maxminkey = str(row.getValue(shapejoincol))
-#             val = float(row.getValue(col))
-#             shpvallist.append([adminval, maxminkey, val])
-#         del row, rows
-#         mydict = {}
-#         shpvallist.sort(key = operator.itemgetter(0,2)) #must sort to use itertools.groupby
-#         for k,g in itertools.groupby(shpvallist, operator.itemgetter(0)):
-#             vals = list(g)
-#             if len(vals) == 0:
-#                 continue
-#             elif len(vals) == 1:
-#                 if float(vals[0][2]) == -9999:
-#                     continue
-#                 maxval =  list(vals[0])
-#                 minval =  list(vals[0])
-#             else:
-#                 vals = [y for y in vals if y[2] <> -9999]
-#                 vals = sorted(vals, key = lambda x: x[2])
-#                 minval = list(vals[0])
-#                 maxval = list(vals[-1])
-#             try:
-#                 if percent_change == True:
-#                     maxval[2] = "{:.0%}".format(maxval[2])
-#                     minval[2] = "{:.0%}".format(minval[2])
-#                 elif diff_lc == True:
-#                     maxval[2] = "{:.2f}".format(maxval[2])
-#                     minval[2] = "{:.2f}".format(minval[2])
-#             except:
-#                 print "Had issues formatting the number: " + maxval[2] + " or " + minval[2]
-#             mydict[k]= {'maxpost':maxval[1],'maxchange':maxval[2],'minpost':minval[1],'minchange':minval[2]}
-#             del minval, maxval
-#         rows = arcpy.da.UpdateCursor(shapefile)
-#         for row in rows:
-#             adminval = row.getValue(aggregation_column)
-#             maxminkey = row.getValue(shapejoincol)
-#             if maxminkey == mydict[adminval]['maxpost']:
-#                     row.setValue(str('L_' + col[:8]),mydict[adminval]['maxchange'])
-#                     rows.updateRow(row)
-#             elif maxminkey == mydict[adminval]['minpost']:
-#                     row.setValue(str('L_' + col[:8]),mydict[adminval]['minchange'])
-#                     rows.updateRow(row)
-#         del row, rows
-#     print newcols
-#     return newcols
 
 # def shp_calcfield(shapefile, fieldname, py_expression):
 #     """Calculate values for a field given a python expression as a string. The py expression should be formatted with ! characters before and after the field name. ie.py_expression ='str(!POSTCODE!) + '_' + str(!JOIN!) """
 #     arcpy.CalculateField_management (shapefile, fieldname, py_expression,"Python")
 
 
-# def mxd_getlist():
-#     """ Returns a list of mxdfiles in the C:\workspace\MXDs folder"""
-#     return glob(os.path.join("C:/Mapping_Project/MXDs","*.mxd"))
-
-# def mxd_getlayers(mxds):
-#     """Prints the available layers in the mxd document. A string version of the layer name is returned. mxd_getlayers(mxds = 'mxdpath' or ['mxdpath1','mxdpath2'])"""
-
-#     lyrlist = []
-#     if isinstance(mxds, list):
-#         for mxdpath in mxds:
-#             print mxdpath
-#             mxd = arcpy.mapping.MapDocument(mxdpath)
-#             i = 0
-#             for lyr in arcpy.mapping.ListLayers(mxd):
-#                 lyrlist.append([os.path.basename(mxdpath), str(lyr.name), i])
-#                 i += 1
-#         print 'MXD/tLAYER/tLAYER_INDEX' #adding cols to what is getting printed
-#         for row in lyrlist:
-#             print row
-#         return lyrlist
-#     elif isinstance(mxds,str):
-#         mxd = arcpy.mapping.MapDocument(mxds)
-#         i = 0
-#         for lyr in arcpy.mapping.ListLayers(mxd):
-#             lyrlist.append([os.path.basename(mxds), str(lyr.name), i])
-#             i += 1
-#         print 'MXD/tLAYER/tLAYER_INDEX'
-#         for row in lyrlist:
-#             print row
-#         return lyrlist
-#     else:
-#         print "The mxd needs to be formatted as a list, not a string. add brackets around the variable ['mxdpath']"
-
-
 
 # def map_create2(mxds,shapefile,mapcols, labelfields, symbology, prefix = False):
 #     """This function will create maps for all mxds specified and all fields in the mapcols list. The symbology options = 'Percent_Change' and 'Diff_LC'. This function allows specification of different label fields for the mapcols labels. ie use mapcols as difference in loss cost, but label the max and min percent change column. The mapcols and labelfields lists must be ordered in the same order so that the first value of mapcols will get labelled with the first value in labelfields."""
@@ -626,102 +2865,3 @@ def map_create1(mxds, shapefile, mapcols, symbology, labels=False, prefix=None,
 #                 outpath = 'C:/Mapping_Project/Out/'+ os.path.basename(mxd).rstrip('.mxd') +'_' + field + '.jpg'
 #                 "Making a map at:", outpath
 #             arcpy.mapping.ExportToJPEG(mxdobj, outpath, resolution=mapresolution)
-
-
-# ###############################################################################
-
-
-# #################NOT WORKING########################
-# def map_create4(mxds,shapefile,shpsubregioncol, mapcols, labelfields, symbology, prefix = False):
-#     """This function will create maps for all mxds specified and all fields in the mapcols list. The symbology options = 'Percent_Change' and 'Diff_LC'. This function allows specification of different label fields for the mapcols labels. ie use mapcols as difference in loss cost, but label the max and min percent change column. The mapcols and labelfields lists must be ordered in the same order so that the first value of mapcols will get labelled with the first value in labelfields. This function will zoom to the different layer attributes specified in the shpsubregioncol field. Currently it's set to only do countries 'be', 'de', and 'uk'"""
-#     i= 0
-#     for col in mapcols:
-#         mapcols[i] = col[:10]
-#         i += 1
-#     i = 0
-#     for col in labelfields:
-#         labelfields[i] = col[:10]
-#         i += 1
-
-#     if isinstance(mxds, str):
-#         newmxd = []
-#         newmxd.append(mxds)
-#         mxds = newmxd
-#     if isinstance(mapcols, str):
-#         newmapcols = []
-#         newmapcols.append(mapcols)
-#         mapcols = newmapcols
-#     if isinstance(labelfields, str):
-#         newlabelfields = []
-#         newlabelfields.append(mapcols)
-#         labelfieldsfields = newlabelfields
-
-#     mapresolution = 300 #300 is common.
-
-#     if symbology.lower() == "percent_change":
-#         symbpath = arcpy.mapping.Layer("C:/Mapping_Project/MXDs/Symbology/PercentChange.lyr")
-#     elif symbology.lower() == "diff_lc":
-#         symbpath = arcpy.mapping.Layer('C:/Mapping_Project/MXDs/Symbology/DifferenceinLossCost.lyr')
-#     elif symbology [-4:] == '.lyr':
-#         symbpath = arcpy.mapping.Layer(symbology)
-#     else:
-#         print "You need to choose a symbology type: 'Percent_Change','Diff_LC', or a layerfile path"
-#         return
-
-#     rows = arcpy.da.SearchCursor(shapefile)
-#     adminIDs = []
-#     for row in rows:
-#         val = row.getValue(shpsubregioncol)
-#         if val not in adminIDs:
-#             adminIDs.append(val)
-#     del rows
-#     for mxd in mxds:
-#         mxdobj = arcpy.mapping.MapDocument(mxd)
-#         df = arcpy.mapping.ListDataFrames(mxdobj)[0] #leave as default for these maps(will it change for other perils????)
-#         for lyr in arcpy.mapping.ListLayers(mxdobj):
-#             if lyr.name == "EUFL_RL15_Zips_Cover":
-#                 lyr2 = lyr
-#             elif lyr.name == "EUFL_RL15_Zips_Cover2":
-#                 lyr3 = lyr
-#         for lyr in arcpy.mapping.ListLayers(mxdobj):
-#             if lyr.name == os.path.basename(shapefile).replace(".shp",""):
-#                 lyr.symbologyType == "GRADUATED_COLORS"
-#                 for field, label in zip(mapcols, labelfields):
-#                     field = field [:10]
-#                     label = label [:10]
-#                     arcpy.mapping.UpdateLayer(df, lyr, symbpath, True)
-#                     lyr.symbology.valueField = field
-#                     expres = "str(int(round(float(["+label+"]) *100,0))) + '%'"
-#                     print expres
-#                     if lyr.supports("LABELCLASSES"):
-#                         print "here"
-#                         lyr.showLabels = True
-#                         for lblClass in lyr.labelClasses:
-#                             lblClass.expression = expres
-#                             lblClass.SQLQuery = field +" <> -9999"
-#                             lblClass.showClassLabels = True
-
-#                     for adminID in adminIDs:
-#                         if adminID[:2] in ['BE','UK','GM']:
-#                             adminID = str(adminID)
-
-#                             query1 = '"'+ shpsubregioncol + '" = ' + "'" + adminID + "'"
-#                             query2 = '"'+ shpsubregioncol + '" <> ' + "'" + adminID + "'"
-#                             query3 = '"'+ shpsubregioncol + '" <> ' + "'" + adminID + "'"
-#                             print shpsubregioncol, adminID, query1
-#                             lyr.definitionQuery =  query1
-#                             lyr2.definitionQuery = query2
-#                             lyr3.definitionQuery = query3
-
-#                             ext = lyr.getSelectedExtent(True)
-#                             df.extent = ext
-#                             # df.panToExtent(lyr.getSelectedExtent())
-#                             # df.zoomToSelectedFeatures()
-#                             arcpy.RefreshActiveView()
-#                             if prefix:
-#                                 outpath = 'C:/Mapping_Project/Out/'+ prefix +'_' + os.path.basename(mxd).rstrip('.mxd') +'_' + field +'.jpg'
-#                                 print "Making a map at:", outpath
-#                             else:
-#                                 outpath = 'C:/Mapping_Project/Out/'+ os.path.basename(mxd).rstrip('.mxd') +'_' + field + '.jpg'
-#                                 "Making a map at:", outpath
-#                             arcpy.mapping.ExportToJPEG(mxdobj, outpath, resolution=mapresolution)
@@ -0,0 +1,344 @@
+"""This script measures the speed and peak memory of the archelper join, sort, coverage check and map export code paths on synthetic data. It does not need ArcGIS. A stand-in for arcpy that keeps tables in memory is loaded before archelper, so it runs on any machine with Python 2.7.
+
+Each case is run in its own process so the peak memory of one case does not hide the next one. The results can be saved and compared with a saved run to catch slow downs.
+
+Usage: python Benchmark_Suite.py [rows ...] [--cases join,join_streaming,join_delta,sort,coverage,maps] [--columns 5] [--save results.json] [--compare results.json]
+
+The default sizes are 10k, 100k and 1M rows. Pass 10000000 to include the 10M row run. It needs several gigabytes of memory because the stand-in tables are held in memory.
+"""
+import argparse
+import csv
+import itertools
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import types
+
+try:
+    import resource
+except ImportError:
+    resource = None
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+SIZES = [10000, 100000, 1000000, 10000000]
+DEFAULT_SIZES = SIZES[:3]
+CASES = ['join', 'join_streaming', 'join_delta', 'sort', 'coverage', 'maps']
+MAP_MXDS = 2
+TOLERANCE = 1.25
+
+
+class StandinField(object):
+    def __init__(self, name, fieldtype):
+        self.name = name
+        self.type = fieldtype
+
+
+class StandinCursor(object):
+    """A search and update cursor over a column store table. 'OID@' and 'FID' return the row number, the same as a shapefile."""
+
+    def __init__(self, table, field_names=None, where_clause=None, sql_clause=None, **kwargs):
+        self.table = TABLES[table]
+        if field_names is None or field_names == '*':
+            field_names = self.table['fields']
+        self.fields = ['FID' if field == 'OID@' else field for field in field_names]
+        self.index = -1
+
+    def __iter__(self):
+        columns = []
+        for field in self.fields:
+            if field == 'FID':
+                columns.append(xrange(self.table['count']))
+            elif field in self.table['columns']:
+                columns.append(self.table['columns'][field])
+            else:
+                columns.append([None] * self.table['count'])
+        for ind, row in enumerate(itertools.izip(*columns)):
+            self.index = ind
+            yield list(row)
+
+    def updateRow(self, row):
+        for field, value in zip(self.fields, row):
+            if field == 'FID':
+                continue
+            column = self.table['columns'].get(field)
+            if column is None:
+                column = self.table['columns'][field] = [None] * self.table['count']
+            column[self.index] = value
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+class StandinLayer(object):
+    """A map layer or symbology layer file with the properties that map_create1 reads and sets."""
+
+    def __init__(self, path=None, name=None):
+        self.name = name or os.path.splitext(os.path.basename(path))[0]
+        self.dataSource = path
+        self.symbologyType = 'GRADUATED_COLORS'
+        self.symbology = types.ModuleType('symbology')
+        self.symbology.numClasses = 5
+        self.symbology.valueField = None
+        self.symbology.classBreakValues = None
+        self.labelClasses = [types.ModuleType('labelclass')]
+        self.showLabels = False
+
+    def supports(self, name):
+        return True
+
+
+class StandinMapDocument(object):
+    def __init__(self, path):
+        self.path = path
+        self.layers = [StandinLayer(name=name) for name in MAP_LAYERS]
+
+
+class StandinDataFrame(object):
+    name = 'Layers'
+
+
+TABLES = {}
+MAP_LAYERS = []
+FIELD_TYPES = {'TEXT': 'String', 'FLOAT': 'Single', 'DOUBLE': 'Double', 'SHORT': 'SmallInteger', 'LONG': 'Integer', 'DATE': 'Date', 'GUID': 'Guid'}
+
+
+def _listfields(table, wild_card=None):
+    table = TABLES[table]
+    return [StandinField(f, table['types'].get(f, 'Double')) for f in table['fields'] if wild_card is None or f.lower() == wild_card.lower()]
+
+
+def _addfield(table, name, datatype, *args, **kwargs):
+    """Adds a field. The AddField keyword ('DOUBLE') is stored as the type ListFields returns ('Double'), the same as arcpy."""
+    TABLES[table]['fields'].append(name)
+    TABLES[table]['types'][name] = FIELD_TYPES.get(datatype.upper(), datatype)
+
+
+def _addfields(table, fields):
+    for name, datatype in fields:
+        _addfield(table, name, datatype)
+
+
+def _deletefield(table, names):
+    if isinstance(names, basestring):
+        names = names.split(';')
+    for name in names:
+        TABLES[table]['fields'].remove(name)
+        TABLES[table]['columns'].pop(name, None)
+
+
+def _describe(table):
+    desc = types.ModuleType('describe')
+    desc.OIDFieldName = 'FID'
+    return desc
+
+
+def _tabletonumpyarray(table, fields, null_value=None, **kwargs):
+    table = TABLES[table]
+    dtype = [(str(field), 'f8') for field in fields]
+    result = numpy.empty(table['count'], dtype=dtype)
+    for field in fields:
+        result[str(field)] = table['columns'][field]
+    return result
+
+
+def _exporttojpeg(mxd, outpath, resolution=None):
+    with open(outpath, 'wb') as outfile:
+        outfile.write('\xff\xd8\xff\xd9')
+
+
+def install_arcpy():
+    """Installs the stand-in arcpy module so archelper can be imported without ArcGIS."""
+    arcpy = types.ModuleType('arcpy')
+    arcpy.da = types.ModuleType('arcpy.da')
+    arcpy.da.UpdateCursor = StandinCursor
+    arcpy.da.SearchCursor = StandinCursor
+    arcpy.da.TableToNumPyArray = _tabletonumpyarray
+    arcpy.ListFields = _listfields
+    arcpy.AddField_management = _addfield
+    arcpy.AddFields_management = _addfields
+    arcpy.DeleteField_management = _deletefield
+    arcpy.Describe = _describe
+    arcpy.Exists = lambda dataset: dataset in TABLES or os.path.exists(dataset)
+    arcpy.RefreshActiveView = lambda: None
+    arcpy.mapping = types.ModuleType('arcpy.mapping')
+    arcpy.mapping.MapDocument = StandinMapDocument
+    arcpy.mapping.Layer = StandinLayer
+    arcpy.mapping.ListDataFrames = lambda mxd, wildcard=None: [StandinDataFrame()]
+    arcpy.mapping.ListLayers = lambda mxd, wildcard=None, data_frame=None: mxd.layers
+    arcpy.mapping.UpdateLayer = lambda df, lyr, source, symbology_only=True: None
+    arcpy.mapping.ExportToJPEG = _exporttojpeg
+    sys.modules['arcpy'] = arcpy
+    sys.modules['arcpy.da'] = arcpy.da
+    sys.modules['arcpy.mapping'] = arcpy.mapping
+    return arcpy
+
+
+def _key(i, rowcount):
+    """Returns the join key for csv row i. The keys are spread over the table so the CSV is not in shapefile order."""
+    return str((i * 7919) % rowcount)
+
+
+def make_data(folder, rowcount, colcount):
+    """Writes a synthetic CSV and registers a matching shapefile table. One CSV row in a hundred is left out so the joins and coverage check have misses. Returns the CSV path, shapefile name and value column names."""
+    cols = ['RP%d_GU' % (i + 1) for i in range(colcount)]
+    csvpath = os.path.join(folder, 'bench.csv')
+    with open(csvpath, 'wb') as outfile:
+        wr = csv.writer(outfile)
+        wr.writerow(['JOIN'] + cols)
+        for i in xrange(rowcount):
+            if i % 100 == 99:
+                continue
+            base = ((i * 2654435761) % 1000003) / 10.0
+            wr.writerow([_key(i, rowcount)] + ['%.4f' % (base + c) for c in range(colcount)])
+    shapefile = os.path.join(folder, 'bench.shp')
+    TABLES[shapefile] = {'fields': ['FID', 'Shape', 'JOIN'], 'types': {'FID': 'OID', 'Shape': 'Geometry', 'JOIN': 'String'},
+                         'columns': {'JOIN': [str(i) for i in xrange(rowcount)]}, 'count': rowcount}
+    return csvpath, shapefile, cols
+
+
+def make_maps(folder, shapefile, cols):
+    """Adds value columns to the shapefile table and writes the empty mxd and layer files used by the maps case. Returns the mxd paths and the layer file path."""
+    table = TABLES[shapefile]
+    for c, col in enumerate(cols):
+        table['fields'].append(col)
+        table['columns'][col] = [((i * 2654435761) % 1000003) / 10.0 + c for i in xrange(table['count'])]
+    MAP_LAYERS[:] = [os.path.splitext(os.path.basename(shapefile))[0], 'Basemap']
+    mxds = []
+    for i in range(MAP_MXDS):
+        mxds.append(os.path.join(folder, 'Map%d.mxd' % (i + 1)))
+        open(mxds[-1], 'wb').close()
+    symbology = os.path.join(folder, 'Symbology.lyr')
+    open(symbology, 'wb').close()
+    os.makedirs(os.path.join(folder, 'C:/Mapping_Project/Out'))
+    return mxds, symbology
+
+
+def peak_memory():
+    """Returns the peak resident memory of this process in megabytes, or None if it can not be read on this system."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return peak / 1048576.0
+    return peak / 1024.0
+
+
+def run_case(case, rowcount, colcount):
+    """Builds the data for one case, runs it and returns a dictionary with the 'seconds', the number of 'items' handled, the item 'unit', the peak memory in megabytes before the case ran ('setup_mb') and after it ran ('peak_mb')."""
+    install_arcpy()
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import archelper
+    folder = tempfile.mkdtemp(prefix='archelper_bench_')
+    cwd = os.getcwd()
+    stdout = sys.stdout
+    try:
+        csvpath, shapefile, cols = make_data(folder, rowcount, colcount)
+        items, unit = rowcount, 'rows'
+        if case == 'maps':
+            mxds, symbology = make_maps(folder, shapefile, cols)
+            items, unit = len(mxds) * len(cols), 'maps'
+            os.chdir(folder)  # map_create1 writes to C:/Mapping_Project/Out, which is a folder in the temp folder here.
+        if case == 'join_delta':
+            sys.stdout = open(os.devnull, 'w')
+            archelper.shp_joincsv(csvpath, shapefile, 'JOIN', 0, 1, delta=True)  # The first delta join writes every row and saves the digests. The second one is timed.
+            sys.stdout = stdout
+        setup = peak_memory()
+        sys.stdout = open(os.devnull, 'w')
+        start = time.time()
+        if case == 'join':
+            archelper.shp_joincsv(csvpath, shapefile, 'JOIN', 0, 1)
+        elif case == 'join_delta':
+            archelper.shp_joincsv(csvpath, shapefile, 'JOIN', 0, 1, delta=True)
+        elif case == 'join_streaming':
+            archelper.shp_joincsv(csvpath, shapefile, 'JOIN', 0, 1, streaming=True)
+        elif case == 'sort':
+            archelper.file_sort(csvpath, 1, coltype='double', outputfile=os.path.join(folder, 'sorted.csv'))
+        elif case == 'coverage':
+            archelper.csv_checkcoverage(csvpath, 0, shapefile, 'JOIN')
+        elif case == 'maps':
+            archelper.map_create1(mxds, shapefile, cols, symbology, labels=True, classbreaks='quantile' if numpy is not None else None)
+        else:
+            raise ValueError('Unknown case: ' + case)
+        seconds = time.time() - start
+    finally:
+        sys.stdout = stdout
+        os.chdir(cwd)
+        shutil.rmtree(folder, ignore_errors=True)
+    return {'case': case, 'rows': rowcount, 'columns': colcount, 'seconds': seconds, 'items': items, 'unit': unit, 'setup_mb': setup, 'peak_mb': peak_memory()}
+
+
+def run(sizes=None, cases=None, colcount=5, save=None, compare=None):
+    """Runs every case at every size in a separate process, prints a table of the results and returns them as a list of dictionaries. If save is a path the results are written to it as json. If compare is the path of saved results, each case is compared with the same case and size in that file and cases more than 25% slower are marked."""
+    sizes = sizes or DEFAULT_SIZES
+    cases = cases or CASES
+    baseline = {}
+    if compare:
+        with open(compare, 'rb') as infile:
+            for result in json.load(infile):
+                baseline[(result['case'], result['rows'], result['columns'])] = result
+    results = []
+    slower = []
+    print '%-15s %10s %10s %14s %10s %10s %10s' % ('CASE', 'ROWS', 'SECONDS', 'PER_SECOND', 'SETUP_MB', 'PEAK_MB', 'BASELINE')
+    for rowcount in sizes:
+        for case in cases:
+            child = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--child', case, str(rowcount), '--columns', str(colcount)], stdout=subprocess.PIPE)
+            output = child.communicate()[0]
+            if child.returncode != 0:
+                print '%-15s %10d failed' % (case, rowcount)
+                continue
+            result = json.loads(output.strip().splitlines()[-1])
+            results.append(result)
+            ratio = ''
+            old = baseline.get((case, rowcount, colcount))
+            if old:
+                ratio = '%.2fx' % (result['seconds'] / max(old['seconds'], 1e-9))
+                if result['seconds'] > old['seconds'] * TOLERANCE:
+                    ratio += ' SLOWER'
+                    result['slower'] = True
+                    slower.append(result)
+            print '%-15s %10d %10.3f %14s %10s %10s %10s' % (case, rowcount, result['seconds'], '%d %s' % (result['items'] / max(result['seconds'], 1e-9), result['unit']),
+                                                           _mb(result['setup_mb']), _mb(result['peak_mb']), ratio)
+    if save:
+        with open(save, 'wb') as outfile:
+            json.dump(results, outfile, indent=2)
+    if slower:
+        print len(slower), 'cases were more than', int((TOLERANCE - 1) * 100), 'percent slower than the baseline.'
+    return results
+
+
+def _mb(value):
+    if value is None:
+        return '-'
+    return '%.1f' % value
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Benchmarks the archelper join, sort, coverage check and map export code paths on synthetic data.')
+    parser.add_argument('rows', nargs='*', type=int, help='Table sizes to run. The default is %s.' % ' '.join(str(size) for size in DEFAULT_SIZES))
+    parser.add_argument('--cases', default=','.join(CASES), help='Comma separated cases to run. The default is all of them.')
+    parser.add_argument('--columns', type=int, default=5, help='Number of value columns to join, sort by and map.')
+    parser.add_argument('--save', help='Saves the results as json.')
+    parser.add_argument('--compare', help='Compares the results with a json file saved with --save.')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+    if args.child:
+        print json.dumps(run_case(args.child, args.rows[0], args.columns))
+        return 0
+    results = run(args.rows, args.cases.split(','), args.columns, args.save, args.compare)
+    if args.compare and [result for result in results if result.get('slower')]:
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,166 @@
+"""This script compares the row writes and run time of shp_joincsv with the old join that called updateRow once per field. It does not need ArcGIS. A small stand-in for arcpy is loaded before archelper so the cursors can be counted.
+
+Usage: python Join_Benchmark.py [rows] [columns]
+"""
+import csv
+import os
+import shutil
+import sys
+import tempfile
+import time
+import types
+
+
+class BenchRow(list):
+    """A cursor row that supports both the list access of arcpy.da rows and the getValue/setValue calls used by the old join."""
+
+    def __init__(self, fields, values):
+        list.__init__(self, values)
+        self.fields = fields
+
+    def getValue(self, field):
+        return self[self.fields.index(field)]
+
+    def setValue(self, field, value):
+        self[self.fields.index(field)] = value
+
+
+class BenchCursor(object):
+    """An update cursor over an in-memory table that counts calls to updateRow."""
+    writes = 0
+
+    def __init__(self, table, field_names=None):
+        self.table = TABLES[table]
+        if field_names is None:
+            field_names = self.table['fields']
+        self.fields = list(field_names)
+        self.index = -1
+
+    def __iter__(self):
+        for ind, record in enumerate(self.table['rows']):
+            self.index = ind
+            yield BenchRow(self.fields, [record.get(f) for f in self.fields])
+
+    def updateRow(self, row):
+        BenchCursor.writes += 1
+        record = self.table['rows'][self.index]
+        for field, value in zip(self.fields, row):
+            record[field] = value
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+class BenchField(object):
+    def __init__(self, name):
+        self.name = name
+
+
+TABLES = {}
+
+
+def _listfields(table, wild_card=None):
+    return [BenchField(f) for f in TABLES[table]['fields'] if wild_card is None or f.lower() == wild_card.lower()]
+
+
+def _addfield(table, name, datatype, *args, **kwargs):
+    TABLES[table]['fields'].append(name)
+
+
+def _addfields(table, fields):
+    for name, datatype in fields:
+        _addfield(table, name, datatype)
+
+
+def _deletefield(table, names):
+    if isinstance(names, str):
+        names = names.split(';')
+    for name in names:
+        TABLES[table]['fields'].remove(name)
+        for record in TABLES[table]['rows']:
+            record.pop(name, None)
+
+
+def install_arcpy():
+    """Installs the stand-in arcpy module so archelper can be imported without ArcGIS."""
+    arcpy = types.ModuleType('arcpy')
+    arcpy.da = types.ModuleType('arcpy.da')
+    arcpy.da.UpdateCursor = BenchCursor
+    arcpy.da.SearchCursor = BenchCursor
+    arcpy.ListFields = _listfields
+    arcpy.AddField_management = _addfield
+    arcpy.AddFields_management = _addfields
+    arcpy.DeleteField_management = _deletefield
+    sys.modules['arcpy'] = arcpy
+    sys.modules['arcpy.da'] = arcpy.da
+    return arcpy
+
+
+def make_data(folder, rowcount, colcount):
+    """Writes a synthetic CSV and registers a matching shapefile table. Returns the CSV path, shapefile name and column names."""
+    cols = ['RP%d_GU' % (i + 1) for i in range(colcount)]
+    csvpath = os.path.join(folder, 'bench.csv')
+    with open(csvpath, 'wb') as outfile:
+        wr = csv.writer(outfile)
+        wr.writerow(['JOIN'] + cols)
+        for i in xrange(rowcount):
+            wr.writerow([str(i)] + ['%.4f' % (i * 0.001 + c) for c in range(colcount)])
+    shapefile = os.path.join(folder, 'bench.shp')
+    TABLES[shapefile] = {'fields': ['FID', 'JOIN'], 'rows': [{'FID': i, 'JOIN': str(i)} for i in xrange(rowcount)]}
+    return csvpath, shapefile, cols
+
+
+def legacy_joincsv(csvfile, shapefile, shapefilejoincol, csvjoinindex, csvstartfield, csvfieldtype="double", filedelimiter=","):
+    """The join loop used before the single write per row change. Kept here only for comparison."""
+    import archelper
+    newcols = [col[:10] for col in archelper.file_getcols(csvfile)[csvstartfield:]]
+    archelper.shp_addcols(shapefile, newcols, csvfieldtype)
+    with open(csvfile, 'rb') as csvdata:
+        lib = dict()
+        csvinfo = csv.reader(csvdata, delimiter=filedelimiter)
+        csvinfo.next()
+        for line in csvinfo:
+            lib[line[csvjoinindex]] = lib.get(line[csvjoinindex], line[csvstartfield:])
+    rows = BenchCursor(shapefile)
+    for row in rows:
+        vals = lib.get(str(row.getValue(shapefilejoincol)))
+        for ind, field in enumerate(newcols):
+            try:
+                if csvfieldtype.lower() == "double":
+                    row.setValue(str(field), float(vals[ind]))
+                elif csvfieldtype.lower() == "text":
+                    row.setValue(str(field), str(vals[ind]))
+                else:
+                    row.setValue(str(field), str(vals[ind]))
+            except:
+                row.setValue(str(field), None)
+            rows.updateRow(row)
+
+
+def run(rowcount=20000, colcount=30):
+    install_arcpy()
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import archelper
+    folder = tempfile.mkdtemp()
+    try:
+        csvpath, shapefile, cols = make_data(folder, rowcount, colcount)
+        results = []
+        for name, func in [('per-field updateRow', legacy_joincsv), ('single write per row', archelper.shp_joincsv)]:
+            BenchCursor.writes = 0
+            start = time.time()
+            func(csvpath, shapefile, 'JOIN', 0, 1)
+            results.append([name, BenchCursor.writes, time.time() - start])
+    finally:
+        shutil.rmtree(folder)
+    print 'Rows: %d  Columns: %d' % (rowcount, colcount)
+    print '%-22s %12s %10s' % ('JOIN', 'ROW_WRITES', 'SECONDS')
+    for name, writes, seconds in results:
+        print '%-22s %12d %10.3f' % (name, writes, seconds)
+    return results
+
+
+if __name__ == '__main__':
+    run(*[int(arg) for arg in sys.argv[1:3]])
@@ -0,0 +1,271 @@
+"""This script checks archelper code paths that do not need ArcGIS. It uses the stand-in for arcpy from Benchmark_Suite.py, which keeps tables in memory, so it runs on any machine with Python 2.7.
+
+Usage: python Standin_Tests.py
+"""
+import csv
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import Benchmark_Suite as standin
+
+standin.install_arcpy()
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import archelper
+
+
+class StandinTestCase(unittest.TestCase):
+    """Makes a temp folder with a stand-in shapefile table named test.shp and removes it after each test."""
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp(prefix='archelper_test_')
+        self.shapefile = os.path.join(self.folder, 'test.shp')
+        standin.TABLES.clear()
+        standin.TABLES[self.shapefile] = {'fields': ['FID', 'Shape', 'JOIN'], 'types': {'FID': 'OID', 'Shape': 'Geometry', 'JOIN': 'String'},
+                                          'columns': {'JOIN': ['0', '1']}, 'count': 2}
+        self.stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+
+    def tearDown(self):
+        sys.stdout.close()
+        sys.stdout = self.stdout
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def writecsv(self, name, rows):
+        """Writes the rows to a CSV in the temp folder and returns its path."""
+        path = os.path.join(self.folder, name)
+        with open(path, 'wb') as outfile:
+            csv.writer(outfile).writerows(rows)
+        return path
+
+    def column(self, field):
+        return standin.TABLES[self.shapefile]['columns'][field]
+
+
+class DeltaJoinTests(StandinTestCase):
+
+    def setUp(self):
+        StandinTestCase.setUp(self)
+        self.v1 = self.writecsv('v1.csv', [['JOIN', 'A'], ['0', '10'], ['1', '20']])
+        self.v2 = self.writecsv('v2.csv', [['JOIN', 'A'], ['0', '11'], ['1', '22']])
+
+    def test_unchanged_rows_are_not_written(self):
+        archelper.shp_joincsv(self.v1, self.shapefile, 'JOIN', 0, 1, delta=True)
+        stats = archelper.shp_joincsv(self.v1, self.shapefile, 'JOIN', 0, 1, delta=True)
+        self.assertEqual(stats['writes'], 0)
+        self.assertEqual(self.column('A'), [10.0, 20.0])
+
+    def test_first_delta_join_counts_matches_as_inserted(self):
+        self.writecsv('v1.csv', [['JOIN', 'A'], ['0', '10']])
+        stats = archelper.shp_joincsv(self.v1, self.shapefile, 'JOIN', 0, 1, delta=True)
+        self.assertEqual((stats['inserted'], stats['changed'], stats['untouched']), (1, 0, 0))
+        self.assertEqual(stats['writes'], 2)
+
+    def test_plain_join_removes_digests(self):
+        archelper.shp_joincsv(self.v1, self.shapefile, 'JOIN', 0, 1, delta=True)
+        archelper.shp_joincsv(self.v2, self.shapefile, 'JOIN', 0, 1)
+        self.assertFalse(os.path.exists(os.path.join(self.folder, 'test.joindigest')))
+        stats = archelper.shp_joincsv(self.v1, self.shapefile, 'JOIN', 0, 1, delta=True)
+        self.assertEqual(stats['writes'], 2)
+        self.assertEqual(self.column('A'), [10.0, 20.0])
+
+    def test_removecols_removes_digests(self):
+        archelper.shp_joincsv(self.v1, self.shapefile, 'JOIN', 0, 1, delta=True)
+        archelper.shp_removecols(self.shapefile, ['A'])
+        self.assertFalse(os.path.exists(os.path.join(self.folder, 'test.joindigest')))
+
+    def test_other_fields_keep_digests(self):
+        archelper.shp_joincsv(self.v1, self.shapefile, 'JOIN', 0, 1, delta=True)
+        archelper.shp_addcols(self.shapefile, ['OTHER'], 'DOUBLE')
+        self.assertTrue(os.path.exists(os.path.join(self.folder, 'test.joindigest')))
+
+
+
+class CsvTableTests(StandinTestCase):
+
+    def setUp(self):
+        StandinTestCase.setUp(self)
+        self.path = self.writecsv('table.csv', [['JOIN', 'A', 'B'], ['00123', '0.50', 'x'], ['2', '', '1e3']])
+
+    def test_numeric_text_is_kept(self):
+        for cache in (False, True, True):
+            table = archelper.CsvTable(self.path, cache=cache)
+            self.assertEqual(list(table.text('A')), ['0.50', ''])
+            self.assertEqual([list(row) for row in table.rows()], [['00123', '0.50', 'x'], ['2', '', '1e3']])
+
+    def test_changed_csv_text_is_not_read(self):
+        table = archelper.CsvTable(self.path)
+        os.utime(self.path, (1, 1))
+        self.assertRaises(ValueError, table.text, 'A')
+
+
+class LabelColsTests(StandinTestCase):
+
+    def test_label_fields_are_unique(self):
+        table = standin.TABLES[self.shapefile]
+        for col, values in [('RP1000_GU', [0.1, -9999]), ('RP1000_GR', [0.25, 0.5])]:
+            table['fields'].append(col)
+            table['columns'][col] = values
+        labelfields = archelper.shp_labelcols(self.shapefile, ['RP1000_GU', 'RP1000_GR'], 'percent')
+        self.assertEqual(labelfields, {'RP1000_GU': 'T_RP1000_G', 'RP1000_GR': 'T_RP1000_1'})
+        self.assertEqual(self.column('T_RP1000_G'), ['10%', ''])
+        self.assertEqual(self.column('T_RP1000_1'), ['25%', '50%'])
+
+
+class StandinIndex(object):
+    def __init__(self, name, fields):
+        self.name = name
+        self.fields = [standin.StandinField(field, 'Double') for field in fields]
+        self.isUnique = False
+        self.isAscending = True
+
+
+class StandinFieldMappings(object):
+    """The field mappings used by Append. Only the field names are kept."""
+
+    def addTable(self, table):
+        self.fields = list(standin.TABLES[table]['fields'])
+
+    def findFieldMapIndex(self, name):
+        return self.fields.index(name) if name in self.fields else -1
+
+    def removeFieldMap(self, index):
+        del self.fields[index]
+
+
+class AlterSchemaTests(StandinTestCase):
+    """Checks shp_alterschema() on ArcMap, where there is no AddFields tool."""
+
+    def setUp(self):
+        StandinTestCase.setUp(self)
+        table = standin.TABLES[self.shapefile]
+        table['fields'].append('VAL')
+        table['columns']['VAL'] = [1.0, 2.0]
+        table['indexes'] = [('JOIN_idx', ['JOIN']), ('VAL_idx', ['VAL'])]
+        open(os.path.join(self.folder, 'test.sbn'), 'wb').close()
+        self.calls = []
+        self.failrename = None
+        self.patches = {'CreateUniqueName': self.createuniquename, 'CreateTable_management': self.createtable, 'FieldMappings': StandinFieldMappings,
+                        'Append_management': self.append, 'Delete_management': self.delete, 'Rename_management': self.rename,
+                        'ListIndexes': lambda table: [StandinIndex(name, fields) for name, fields in standin.TABLES[table].get('indexes', [])],
+                        'AddIndex_management': self.addindex, 'AddSpatialIndex_management': lambda table: self.calls.append(('AddSpatialIndex', table)),
+                        'AddField_management': self.addfield}
+        self.saved = dict((name, getattr(archelper.arcpy, name, None)) for name in self.patches.keys() + ['AddFields_management'])
+        for name, func in self.patches.iteritems():
+            setattr(archelper.arcpy, name, func)
+        del archelper.arcpy.AddFields_management
+
+    def tearDown(self):
+        for name, func in self.saved.iteritems():
+            if func is None:
+                delattr(archelper.arcpy, name)
+            else:
+                setattr(archelper.arcpy, name, func)
+        StandinTestCase.tearDown(self)
+
+    def addfield(self, table, name, datatype, *args, **kwargs):
+        self.calls.append(('AddField', table, name))
+        standin._addfield(table, name, datatype)
+
+    def createuniquename(self, name, workspace):
+        base, extension = os.path.splitext(name)
+        i = 0
+        while os.path.join(workspace, base + str(i) + extension) in standin.TABLES:
+            i += 1
+        return os.path.join(workspace, base + str(i) + extension)
+
+    def createtable(self, workspace, name, template):
+        source = standin.TABLES[template]
+        standin.TABLES[os.path.join(workspace, name)] = {'fields': list(source['fields']), 'types': dict(source['types']), 'columns': {}, 'count': 0}
+
+    def append(self, source, target, schema_type, fieldmappings):
+        source, target = standin.TABLES[source], standin.TABLES[target]
+        for field in fieldmappings.fields:
+            if field in target['fields'] and field in source['columns']:
+                target['columns'][field] = list(source['columns'][field])
+        target['count'] = source['count']
+
+    def delete(self, table):
+        self.calls.append(('Delete', table))
+        del standin.TABLES[table]
+
+    def rename(self, source, target):
+        if source == self.failrename:
+            raise IOError("Rename failed")
+        standin.TABLES[target] = standin.TABLES.pop(source)
+
+    def addindex(self, table, fields, name, *args):
+        standin.TABLES[table].setdefault('indexes', []).append((name, list(fields)))
+
+    def test_fields_are_added_in_place_by_default(self):
+        table = standin.TABLES[self.shapefile]
+        archelper.shp_alterschema(self.shapefile, add=['A', 'B'])
+        self.assertIs(standin.TABLES[self.shapefile], table)
+        self.assertEqual([call[2] for call in self.calls if call[0] == 'AddField'], ['A', 'B'])
+        self.assertEqual(table['indexes'], [('JOIN_idx', ['JOIN']), ('VAL_idx', ['VAL'])])
+
+    def test_rebuild_keeps_rows_and_indexes(self):
+        archelper.shp_alterschema(self.shapefile, add=['A'], drop=['VAL'], rebuild=True)
+        table = standin.TABLES[self.shapefile]
+        self.assertEqual(table['fields'], ['FID', 'Shape', 'JOIN', 'A'])
+        self.assertEqual(table['columns']['JOIN'], ['0', '1'])
+        self.assertEqual(table['indexes'], [('JOIN_idx', ['JOIN'])])
+        self.assertIn(('AddSpatialIndex', self.shapefile), self.calls)
+        self.assertEqual(sorted(standin.TABLES), [self.shapefile])
+
+    def test_rebuild_keeps_original_when_rename_fails(self):
+        self.failrename = os.path.join(self.folder, 'test0.shp')
+        self.assertRaises(IOError, archelper.shp_alterschema, self.shapefile, add=['A'], rebuild=True)
+        table = standin.TABLES[self.shapefile]
+        self.assertEqual(table['fields'], ['FID', 'Shape', 'JOIN', 'VAL'])
+        self.assertEqual(table['columns']['VAL'], [1.0, 2.0])
+        self.assertEqual(sorted(standin.TABLES), [self.shapefile])
+
+
+
+class ClassBreakTests(StandinTestCase):
+    """Checks that custom class breaks are only used for the fields they were given for."""
+
+    def setUp(self):
+        StandinTestCase.setUp(self)
+        self.mxds, self.symbology = standin.make_maps(self.folder, self.shapefile, ['RP1_GU', 'RP2_GU'])
+        self.cwd = os.getcwd()
+        os.chdir(self.folder)
+        self.exported = []
+        self.saved = archelper.arcpy.mapping.UpdateLayer, archelper.arcpy.mapping.ExportToJPEG
+        archelper.arcpy.mapping.UpdateLayer = self.updatelayer
+        archelper.arcpy.mapping.ExportToJPEG = self.exporttojpeg
+
+    def tearDown(self):
+        archelper.arcpy.mapping.UpdateLayer, archelper.arcpy.mapping.ExportToJPEG = self.saved
+        os.chdir(self.cwd)
+        StandinTestCase.tearDown(self)
+
+    def updatelayer(self, df, lyr, source, symbology_only=True):
+        lyr.symbology.classBreakValues = [0, 10, 20, 30, 40, 50]  # The breaks saved in the layer file.
+
+    def exporttojpeg(self, mxd, outpath, resolution=None):
+        lyr = mxd.layers[0]
+        self.exported.append((lyr.symbology.valueField, list(lyr.symbology.classBreakValues)))
+        standin._exporttojpeg(mxd, outpath, resolution)
+
+    def test_fields_without_breaks_use_layer_breaks(self):
+        archelper.map_create1(self.mxds[:1], self.shapefile, ['RP1_GU', 'RP2_GU'], self.symbology, classbreaks={'RP1_GU': [0, 1, 2, 3, 4, 5]})
+        self.assertEqual(self.exported, [('RP1_GU', [0, 1, 2, 3, 4, 5]), ('RP2_GU', [0, 10, 20, 30, 40, 50])])
+
+    def test_repeated_breaks_are_not_set_again(self):
+        archelper.map_create1(self.mxds[:1], self.shapefile, ['RP1_GU', 'RP2_GU'], self.symbology, classbreaks={'RP1_GU': [0, 1, 2], 'RP2_GU': [0, 1, 2]})
+        self.assertEqual(self.exported, [('RP1_GU', [0, 1, 2]), ('RP2_GU', [0, 1, 2])])
+
+
+    def test_repeated_breaks_are_dropped(self):
+        columns = {'A': [1, 1, 1, 1, 1, 2], 'B': [3, 3, 3]}
+        self.assertEqual(archelper._calc_classbreaks(columns, 'quantile', 5, -9999), {'A': [1.0, 2.0], 'B': [3.0]})
+        self.assertEqual(archelper._calc_classbreaks(columns, 'equal_interval', 5, -9999)['B'], [3.0])
+
+
+if __name__ == '__main__':
+    unittest.main()